@@ -1,7 +1,10 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, status, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, ReturnDocument, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta, timezone
@@ -11,13 +14,22 @@ import os
 import logging
 import uuid
 import asyncio
+import base64
+import heapq
+import bson
 import json
+import msgpack
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import io
 from sklearn.ensemble import IsolationForest
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
 from pathlib import Path
 from dotenv import load_dotenv
-import random
+import re
 import threading
 import time
 
@@ -45,25 +57,324 @@ app = FastAPI(title="Smart Industrial Energy Monitoring System")
 api_router = APIRouter(prefix="/api")
 
 # WebSocket connection manager
+# State updates a newer one supersedes, so a slow client may lose queued ones
+CONFLATABLE_TYPES = {"frame", "sensor_reading", "dashboard_summary"}
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, max_queue: int, user: Optional["User"] = None):
+        self.websocket = websocket
+        self.user = user
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        # Subscription; None means "everything" for that dimension
+        self.types: Optional[set] = None
+        self.device_ids: Optional[set] = None
+        self.locations: Optional[set] = None
+        self.min_severity = 0
+        # Batched frame mode: readings arrive as combined frames instead of one message each
+        self.frames = False
+        self.delta = False
+        self.encoding = "json"
+        self.needs_keyframe = True
+
+    def wants(self, message_type: Optional[str], severity: Optional[str]) -> bool:
+        if self.frames and message_type == "sensor_reading":
+            return False
+        if self.types is not None and message_type not in self.types:
+            return False
+        if severity is not None and SEVERITY_LEVELS.index(severity) < self.min_severity:
+            return False
+        return True
+
+    def subscription(self) -> dict:
+        return {
+            "types": sorted(self.types) if self.types is not None else None,
+            "device_ids": sorted(self.device_ids) if self.device_ids is not None else None,
+            "locations": sorted(self.locations) if self.locations is not None else None,
+            "min_severity": SEVERITY_LEVELS[self.min_severity],
+            "frames": self.frames,
+            "delta": self.delta,
+            "encoding": self.encoding
+        }
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, max_queue: int = 100, slow_client_policy: str = "conflate",
+                 frame_window_ms: float = 250, keyframe_interval: int = 20):
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        # Topic index: clients without a device/location filter, and clients per device id / location
+        self.unscoped: set = set()
+        self.by_device: Dict[str, set] = {}
+        self.by_location: Dict[str, set] = {}
+        self.max_queue = max_queue
+        self.slow_client_policy = slow_client_policy  # conflate (drop oldest frame) or disconnect
+        self.messages = 0
+        self.dropped = 0
+        self.pruned = 0
+        # Frame batching: latest staged reading per device, and the last values sent for delta encoding
+        self.frame_clients: set = set()
+        self.frame_window = frame_window_ms / 1000
+        self.keyframe_interval = keyframe_interval
+        self.staged: Dict[str, dict] = {}
+        self.last_values: Dict[str, list] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.frame_seq = 0
+        self.frames_sent = 0
+        # Cross-worker relay; set once the bus is built
+        self.bus: Optional["BroadcastBus"] = None
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.clients)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, user: Optional["User"] = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(websocket, self.max_queue, user)
+        client.task = asyncio.create_task(self.writer(client))
+        self.clients[websocket] = client
+        self.unscoped.add(client)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client:
+            self.unindex(client)
+        if client and client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json.dumps(message))
-            except:
-                pass
+    def unindex(self, client: ClientConnection):
+        self.unscoped.discard(client)
+        self.frame_clients.discard(client)
+        for index, keys in ((self.by_device, client.device_ids), (self.by_location, client.locations)):
+            for key in keys or ():
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(client)
+                    if not subscribers:
+                        del index[key]
+
+    @staticmethod
+    def validate_subscription(request: dict):
+        for field in ("types", "device_ids", "locations"):
+            value = request.get(field)
+            if value is not None and not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+                raise ValueError(f"{field} must be a list of strings")
+        min_severity = request.get("min_severity")
+        if min_severity is not None and min_severity not in SEVERITY_LEVELS:
+            raise ValueError(f"min_severity must be one of {', '.join(SEVERITY_LEVELS)}")
+
+    def subscribe(self, websocket: WebSocket, request: dict) -> dict:
+        # Validated up front, so a rejected request leaves the current subscription in place
+        self.validate_subscription(request)
+        client = self.clients[websocket]
+        self.unindex(client)
+        types = request.get("types")
+        device_ids = request.get("device_ids")
+        locations = request.get("locations")
+        client.types = set(types) if types else None
+        client.device_ids = set(device_ids) if device_ids else None
+        client.locations = set(locations) if locations else None
+        min_severity = request.get("min_severity") or "low"
+        client.min_severity = SEVERITY_LEVELS.index(min_severity)
+        client.frames = bool(request.get("frames"))
+        client.delta = bool(request.get("delta"))
+        client.encoding = "msgpack" if request.get("encoding") == "msgpack" else "json"
+        client.needs_keyframe = True
+        if client.frames:
+            self.frame_clients.add(client)
+        if client.device_ids is None and client.locations is None:
+            self.unscoped.add(client)
+        for index, keys in ((self.by_device, client.device_ids), (self.by_location, client.locations)):
+            for key in keys or ():
+                index.setdefault(key, set()).add(client)
+        return client.subscription()
+
+    def recipients(self, device_id: Optional[str]) -> set:
+        if device_id is None:
+            return set(self.clients.values())
+        recipients = set(self.unscoped)
+        recipients.update(self.by_device.get(device_id, ()))
+        device = device_registry.get(device_id)
+        if device is not None:
+            recipients.update(self.by_location.get(device.location, ()))
+        return recipients
+
+    async def writer(self, client: ClientConnection):
+        # One writer per client, so a slow socket only ever delays itself
+        try:
+            while True:
+                payload, _ = await client.queue.get()
+                if isinstance(payload, bytes):
+                    await client.websocket.send_bytes(payload)
+                else:
+                    await client.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.pruned += 1
+            self.disconnect(client.websocket)
+
+    def enqueue(self, client: ClientConnection, payload, message_type: Optional[str] = None):
+        if client.queue.full() and (self.slow_client_policy == "disconnect" or not self.conflate(client)):
+            self.pruned += 1
+            self.disconnect(client.websocket)
+            asyncio.create_task(self.close(client.websocket))
+            return
+        client.queue.put_nowait((payload, message_type))
+
+    def conflate(self, client: ClientConnection) -> bool:
+        """Drop the oldest queued state update, which newer state supersedes.
+
+        Alerts and acks are never dropped; a queue holding nothing else cannot be conflated.
+        """
+        queued = [client.queue.get_nowait() for _ in range(client.queue.qsize())]
+        index = next((index for index, (_, message_type) in enumerate(queued) if message_type in CONFLATABLE_TYPES), None)
+        if index is not None:
+            _, message_type = queued.pop(index)
+            client.dropped += 1
+            self.dropped += 1
+            # A dropped delta breaks the client's baseline
+            if message_type == "frame":
+                client.needs_keyframe = True
+        for item in queued:
+            client.queue.put_nowait(item)
+        return index is not None
+
+    async def close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # try again later
+        except Exception:
+            pass
+
+    async def send(self, websocket: WebSocket, text: str, message_type: Optional[str] = None):
+        client = self.clients.get(websocket)
+        if client:
+            self.enqueue(client, text, message_type)
+
+    async def broadcast(self, message: dict, device_id: Optional[str] = None, severity: Optional[str] = None):
+        self.deliver(message, device_id, severity)
+        # Other workers hold their own sockets
+        if self.bus is not None:
+            self.bus.publish({"kind": "broadcast", "message": message, "device_id": device_id, "severity": severity})
+
+    def deliver(self, message: dict, device_id: Optional[str] = None, severity: Optional[str] = None):
+        # Only subscribers of the device (or its location) are touched
+        recipients = [client for client in self.recipients(device_id) if client.wants(message.get("type"), severity)]
+        if not recipients:
+            return
+        # Serialize once for every client; sends happen on the per-client writer tasks
+        text = json.dumps(message, default=str)
+        self.messages += 1
+        for client in recipients:
+            self.enqueue(client, text, message.get("type"))
+
+    def deliver_readings(self, readings: List[dict], device_names: List[str]):
+        """Deliver a tick of readings as sensor_reading messages, then as one combined frame"""
+        for reading, device_name in zip(readings, device_names):
+            self.deliver({"type": "sensor_reading", "data": reading, "device_name": device_name}, reading["device_id"])
+            self.stage_reading(reading["device_id"], reading)
+        self.flush_frames()
+
+    def stage_reading(self, device_id: str, reading: dict):
+        """Stage a reading for the next combined frame; later readings of a device replace earlier ones"""
+        if not self.frame_clients:
+            return
+        self.staged[device_id] = reading
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.frame_window, self.flush_frames)
+
+    def flush_frames(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        staged, self.staged = self.staged, {}
+        if not staged:
+            return
+        self.frame_seq += 1
+        periodic_keyframe = self.frame_seq % self.keyframe_interval == 0
+        
+        rows = {}
+        deltas = {}
+        for device_id, reading in staged.items():
+            row = [reading.get(field) for field in SENSOR_METRICS]
+            previous = self.last_values.get(device_id)
+            rows[device_id] = row
+            deltas[device_id] = {
+                field: value for index, (field, value) in enumerate(zip(SENSOR_METRICS, row))
+                if previous is None or previous[index] != value
+            }
+        
+        # Route each staged device to its interested frame clients via the topic index
+        views: Dict[ClientConnection, List[str]] = {}
+        for device_id in staged:
+            for client in self.recipients(device_id):
+                if client.frames and (client.types is None or "sensor_reading" in client.types):
+                    views.setdefault(client, []).append(device_id)
+        
+        # Keyframes carry every device of the client's view, including ones not staged in this window
+        self.last_values.update(rows)
+        full_views: Dict[tuple, List[str]] = {}
+        
+        # Clients with the same view, encoding and frame kind share one serialized payload
+        encoded: Dict[tuple, Any] = {}
+        timestamp = datetime.now(timezone.utc).isoformat()
+        for client, device_ids in views.items():
+            # On a full queue this frame replaces a queued one, so it cannot be a delta on top of it
+            keyframe = not client.delta or client.needs_keyframe or periodic_keyframe or client.queue.full()
+            if keyframe:
+                scope = (frozenset(client.device_ids or ()), frozenset(client.locations or ()))
+                if scope not in full_views:
+                    full_views[scope] = self.frame_view(client)
+                device_ids = full_views[scope]
+            key = (tuple(device_ids), keyframe, client.encoding)
+            payload = encoded.get(key)
+            if payload is None:
+                frame = {"type": "frame", "seq": self.frame_seq, "keyframe": keyframe, "ts": timestamp}
+                if keyframe:
+                    frame["fields"] = SENSOR_METRICS
+                    frame["devices"] = {device_id: self.last_values[device_id] for device_id in device_ids}
+                else:
+                    frame["devices"] = {device_id: deltas[device_id] for device_id in device_ids if deltas[device_id]}
+                payload = msgpack.packb(frame) if client.encoding == "msgpack" else json.dumps(frame)
+                encoded[key] = payload
+            self.enqueue(client, payload, "frame")
+            if keyframe:
+                client.needs_keyframe = False
+        self.frames_sent += len(views)
 
-manager = ConnectionManager()
+    def frame_view(self, client: ClientConnection) -> List[str]:
+        """Devices with a last value that the client's subscription covers"""
+        if client.device_ids is None and client.locations is None:
+            return list(self.last_values)
+        view = [device_id for device_id in client.device_ids or () if device_id in self.last_values]
+        if client.locations is not None:
+            for device_id in self.last_values:
+                device = device_registry.get(device_id)
+                if device is not None and device.location in client.locations and device_id not in (client.device_ids or ()):
+                    view.append(device_id)
+        return view
+
+    def stats(self) -> dict:
+        depths = [client.queue.qsize() for client in self.clients.values()]
+        return {
+            "clients": len(self.clients),
+            "users": len({client.user.username for client in self.clients.values() if client.user}),
+            "subscribed_devices": len(self.by_device),
+            "subscribed_locations": len(self.by_location),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "frame_clients": len(self.frame_clients),
+            "frames_sent": self.frames_sent,
+            "messages": self.messages,
+            "dropped": self.dropped,
+            "pruned": self.pruned
+        }
+
+manager = ConnectionManager(
+    max_queue=int(os.environ.get('WS_CLIENT_QUEUE_SIZE', 100)),
+    slow_client_policy=os.environ.get('WS_SLOW_CLIENT_POLICY', 'conflate'),
+    frame_window_ms=float(os.environ.get('WS_FRAME_WINDOW_MS', 250)),
+    keyframe_interval=int(os.environ.get('WS_KEYFRAME_INTERVAL', 20))
+)
 
 # Pydantic Models
 class User(BaseModel):
@@ -96,6 +407,7 @@ class Device(BaseModel):
     location: str
     status: str = "active"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    virtual: bool = False  # simulator padding for load tests, hidden from device views
 
 class DeviceCreate(BaseModel):
     name: str
@@ -128,17 +440,96 @@ class Alert(BaseModel):
     severity: str  # low, medium, high, critical
     message: str
     acknowledged: bool = False
+    acknowledged_at: Optional[datetime] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    occurrences: int = 1  # repeats coalesced into this alert
+    last_seen: Optional[datetime] = None
 
 class AlertAck(BaseModel):
     alert_id: str
 
+class AlertBulkAck(BaseModel):
+    # Either explicit ids or a filter; criteria combine with AND
+    alert_ids: Optional[List[str]] = None
+    device_id: Optional[str] = None
+    metric: Optional[str] = None
+    severity: Optional[str] = None
+    from_time: Optional[datetime] = None
+    to_time: Optional[datetime] = None
+
+class UserRoleUpdate(BaseModel):
+    role: str
+
 class ThresholdConfig(BaseModel):
-    device_id: str
+    device_id: Optional[str] = None
+    device_type: Optional[str] = None
     metric: str
     min_threshold: Optional[float] = None
     max_threshold: Optional[float] = None
 
+class SimulationConfig(BaseModel):
+    device_count: Optional[int] = None
+    tick_seconds: Optional[float] = None
+    anomaly_rate: Optional[float] = None
+    seed: Optional[int] = None
+
+SENSOR_METRICS = ['power_kw', 'temperature_c', 'vibration', 'runtime_hours']
+
+# Bounded LRU/TTL cache of bearer token -> User
+class PrincipalCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> Optional[User]:
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[token]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return user
+
+    def put(self, token: str, user: User, token_exp: Optional[float] = None):
+        # Never cache a principal past the expiry of the token itself
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        self.entries[token] = (user, expires_at)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_user(self, username: str):
+        for token in [token for token, (user, _) in self.entries.items() if user.username == username]:
+            del self.entries[token]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+principal_cache = PrincipalCache(
+    max_size=int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', 60))
+)
+
 # Utility functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -156,14 +547,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def authenticate_token(token: str) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+    
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -173,7 +568,48 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     user = await db.users.find_one({"username": username})
     if user is None:
         raise credentials_exception
-    return User(**user)
+    user = User(**user)
+    principal_cache.put(token, user, payload.get("exp"))
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+async def insert_many_unordered(collection, documents: List[dict], duplicates_ok: bool = False) -> List[int]:
+    """Insert documents in a single unordered round trip, returning indexes that failed.
+
+    With `duplicates_ok`, duplicate key errors count as stored, which is what a concurrent
+    writer of the same unique id sees.
+    """
+    if not documents:
+        return []
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        return [
+            error['index'] for error in e.details.get('writeErrors', [])
+            if not (duplicates_ok and error.get('code') == 11000)
+        ]
+    return []
+
+async def insert_missing(collection, documents: List[dict]) -> List[int]:
+    """Insert the documents an earlier, failed attempt did not store, returning indexes that failed.
+
+    Time-series collections enforce no unique index, so instead of relying on duplicate key
+    errors this looks up which ids already landed. The timestamp bounds keep the lookup on the
+    (timestamp, id) index.
+    """
+    if not documents:
+        return []
+    timestamps = [document["timestamp"] for document in documents]
+    landed = await collection.find(
+        {"timestamp": {"$gte": min(timestamps), "$lte": max(timestamps)}, "id": {"$in": [document["id"] for document in documents]}},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    landed_ids = {document["id"] for document in landed}
+    missing = [index for index, document in enumerate(documents) if document["id"] not in landed_ids]
+    failed = await insert_many_unordered(collection, [documents[index] for index in missing], duplicates_ok=True)
+    return [missing[index] for index in failed]
 
 def require_role(allowed_roles: List[str]):
     def role_checker(current_user: User = Depends(get_current_user)):
@@ -185,9 +621,1585 @@ def require_role(allowed_roles: List[str]):
         return current_user
     return role_checker
 
+# In-memory device registry
+class DeviceRegistry:
+    def __init__(self, refresh_interval: float = 60):
+        self.by_id: Dict[str, Device] = {}
+        self.by_name: Dict[str, Device] = {}
+        self.virtual_ids: set = set()
+        self.refresh_interval = refresh_interval
+        self.task: Optional[asyncio.Task] = None
+
+    async def load(self):
+        devices = await db.devices.find().to_list(None)
+        by_id = {}
+        by_name = {}
+        for device_doc in devices:
+            device = Device(**device_doc)
+            by_id[device.id] = device
+            by_name[device.name] = device
+        # Swap the indexes at once so readers never see a half-built registry
+        self.by_id, self.by_name = by_id, by_name
+        self.virtual_ids = {device.id for device in by_id.values() if device.virtual}
+
+    def add(self, device: Device):
+        self.by_id[device.id] = device
+        self.by_name[device.name] = device
+        if device.virtual:
+            self.virtual_ids.add(device.id)
+
+    def remove(self, device_id: str):
+        device = self.by_id.pop(device_id, None)
+        self.virtual_ids.discard(device_id)
+        if device and self.by_name.get(device.name) is device:
+            del self.by_name[device.name]
+
+    def get(self, device_id: str) -> Optional[Device]:
+        return self.by_id.get(device_id)
+
+    def get_by_name(self, name: str) -> Optional[Device]:
+        return self.by_name.get(name)
+
+    def device_type(self, device_id: str) -> Optional[str]:
+        device = self.by_id.get(device_id)
+        return device.type if device else None
+
+    def all(self, include_virtual: bool = False) -> List[Device]:
+        if include_virtual or not self.virtual_ids:
+            return list(self.by_id.values())
+        return [device for device in self.by_id.values() if not device.virtual]
+
+    def __len__(self):
+        # Real devices only; virtual ones still resolve through get() and device_type()
+        return len(self.by_id) - len(self.virtual_ids)
+
+    def apply_change(self, change: dict):
+        operation = change.get('operationType')
+        if operation in ('insert', 'update', 'replace'):
+            document = change.get('fullDocument')
+            if document:
+                previous = self.by_id.get(document['id'])
+                if previous:
+                    self.remove(previous.id)
+                self.add(Device(**document))
+        elif operation == 'delete':
+            # Deletes only carry the Mongo _id, so resync from the collection
+            asyncio.create_task(self.load())
+
+    async def sync(self):
+        # Prefer a change stream (replica sets only), fall back to TTL refresh
+        try:
+            async with db.devices.watch(full_document="updateLookup") as stream:
+                logging.info("Device registry following devices change stream")
+                async for change in stream:
+                    self.apply_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.info(f"Device change stream unavailable ({e}), refreshing every {self.refresh_interval}s")
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.load()
+            except Exception as e:
+                logging.error(f"Device registry refresh error: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.sync())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+device_registry = DeviceRegistry(refresh_interval=float(os.environ.get('DEVICE_REGISTRY_REFRESH_SECONDS', 60)))
+
+# Cross-worker event bus: each worker only holds its own sockets and caches
+class BroadcastBus:
+    """Single-worker bus; events never leave the process, so publishing is a no-op"""
+    backend = "local"
+
+    def __init__(self):
+        self.published = 0
+        self.received = 0
+
+    def publish(self, event: dict):
+        pass
+
+    def dispatch(self, event: dict):
+        """Apply an event published by another worker to this worker's state"""
+        kind = event.get("kind")
+        if kind == "broadcast":
+            manager.deliver(event["message"], event.get("device_id"), event.get("severity"))
+        elif kind == "readings":
+            latest_readings.update(event["readings"])
+            # Simulator ticks also go out to subscribers; ingested batches only feed the cache
+            if "device_names" in event:
+                manager.deliver_readings(event["readings"], event["device_names"])
+        elif kind == "alert_closed":
+            if "filter" in event:
+                asyncio.create_task(alert_coalescer.close_acknowledged(**event["filter"]))
+            for alert_id in event.get("alert_ids", []):
+                alert_coalescer.close(alert_id)
+        elif kind == "invalidate_user":
+            principal_cache.invalidate_user(event["username"])
+        elif kind == "threshold_override":
+            anomaly_detector.apply_threshold_override(ThresholdConfig(**event["config"]), remove=event.get("remove", False))
+        elif kind == "device":
+            device = Device(**event["device"])
+            if device_registry.get(device.id) is None:
+                device_registry.add(device)
+        self.received += 1
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "published": self.published, "received": self.received}
+
+class MongoBroadcastBus(BroadcastBus):
+    """Relays events through a capped collection that every worker tails.
+
+    Tailable cursors work on a standalone mongod as well as replica sets, so no
+    extra broker is needed to run several uvicorn workers.
+    """
+    backend = "mongo"
+
+    def __init__(self, collection_name: str = "broadcast_bus", size_bytes: int = 16 * 1024 * 1024):
+        super().__init__()
+        self.collection = db[collection_name]
+        self.size_bytes = size_bytes
+        self.origin = uuid.uuid4().hex
+        self.outbox: List[dict] = []
+        self.flush_task: Optional[asyncio.Task] = None
+        self.task: Optional[asyncio.Task] = None
+        self.enabled = False
+        self.errors = 0
+
+    def publish(self, event: dict):
+        if not self.enabled:
+            return
+        self.outbox.append({**event, "origin": self.origin, "ts": datetime.now(timezone.utc)})
+        # Everything published during this loop turn goes out as one insert
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(0)
+        events, self.outbox = self.outbox, []
+        self.flush_task = None
+        if not events:
+            return
+        try:
+            await self.collection.insert_many(events, ordered=False)
+            self.published += len(events)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Broadcast bus publish error: {e}")
+
+    async def tail(self):
+        # Only events published after startup matter; readings are live data
+        query = {"ts": {"$gte": datetime.now(timezone.utc)}}
+        while True:
+            try:
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for event in cursor:
+                        query = {"_id": {"$gt": event["_id"]}}
+                        if event.get("origin") != self.origin:
+                            self.dispatch(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Broadcast bus tail error: {e}")
+            # A tailable cursor dies on an empty collection or when it falls behind the cap
+            await asyncio.sleep(1)
+
+    async def start(self):
+        try:
+            try:
+                await db.create_collection(self.collection.name, capped=True, size=self.size_bytes)
+            except CollectionInvalid:
+                pass  # already created by another worker
+            options = await self.collection.options()
+            if not options.get("capped"):
+                raise RuntimeError(f"{self.collection.name} exists but is not a capped collection")
+        except Exception as e:
+            logging.error(f"Broadcast bus unavailable ({e}), events stay local to this worker")
+            return
+        self.enabled = True
+        self.task = asyncio.create_task(self.tail())
+
+    async def stop(self):
+        if self.flush_task:
+            await self.flush_task
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> dict:
+        return {**super().stats(), "enabled": self.enabled, "origin": self.origin, "errors": self.errors}
+
+def create_broadcast_bus(backend: str) -> BroadcastBus:
+    if backend == "auto":
+        # uvicorn --workers also reads WEB_CONCURRENCY
+        backend = "mongo" if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 else "local"
+    if backend == "mongo":
+        return MongoBroadcastBus(size_bytes=int(os.environ.get('WS_BROADCAST_BUS_BYTES', 16 * 1024 * 1024)))
+    return BroadcastBus()
+
+broadcast_bus = create_broadcast_bus(os.environ.get('WS_BROADCAST_BUS', 'auto'))
+manager.bus = broadcast_bus
+
+# Continuous per-device rollups maintained at write time
+ROLLUP_RESOLUTIONS = {'1m': '1min', '1h': '1h', '1d': '1D'}
+
+class ReadingRollups:
+    def __init__(self, retention: Optional[Dict[str, float]] = None):
+        # Seconds each resolution is kept after its bucket closes; missing or 0 keeps it forever
+        self.retention = retention or {}
+        self.upserts = 0
+        self.rebuilt = 0
+        # [from, to) ranges of stored readings whose rollup update failed, awaiting repair
+        self.stale: List[tuple] = []
+        self.backfilled_through: Optional[datetime] = None
+        self.backfill_until: Optional[datetime] = None
+
+    @staticmethod
+    def summarize(frame: pd.DataFrame, frequency: str) -> Dict[tuple, dict]:
+        """Per (device_id, bucket) count and per-metric sum/sumsq/min/max of a readings frame"""
+        keys = [frame["device_id"], frame["timestamp"].dt.floor(frequency).rename("bucket")]
+        stats = frame[SENSOR_METRICS].groupby(keys).agg(["count", "sum", "min", "max"])
+        sumsq = (frame[SENSOR_METRICS] ** 2).groupby(keys).sum()
+        summaries = {}
+        for (device_id, bucket), row in stats.iterrows():
+            summary = {"count": int(row[(SENSOR_METRICS[0], "count")])}
+            for metric in SENSOR_METRICS:
+                summary[metric] = {
+                    "sum": float(row[(metric, "sum")]),
+                    "sumsq": float(sumsq.at[(device_id, bucket), metric]),
+                    "min": float(row[(metric, "min")]),
+                    "max": float(row[(metric, "max")])
+                }
+            summaries[(device_id, bucket.to_pydatetime())] = summary
+        return summaries
+
+    @staticmethod
+    def summary_pipeline(from_time: datetime, to_time: datetime, frequency: str) -> List[dict]:
+        """Server-side summarize() of raw readings in [from_time, to_time), one group per (device_id, bucket)"""
+        bin_seconds = int(pd.Timedelta(frequency).total_seconds())
+        group = {
+            "_id": {
+                "device_id": "$device_id",
+                "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": "second", "binSize": bin_seconds}}
+            },
+            "count": {"$sum": 1}
+        }
+        for metric in SENSOR_METRICS:
+            group[f"{metric}_sum"] = {"$sum": f"${metric}"}
+            group[f"{metric}_sumsq"] = {"$sum": {"$multiply": [f"${metric}", f"${metric}"]}}
+            group[f"{metric}_min"] = {"$min": f"${metric}"}
+            group[f"{metric}_max"] = {"$max": f"${metric}"}
+        return [{"$match": {"timestamp": {"$gte": from_time, "$lt": to_time}}}, {"$group": group}]
+
+    async def stored_summaries(self, from_time: datetime, to_time: datetime, frequency: str, batch_size: int = 5000):
+        """Yield summarize() of stored readings in batches of at most `batch_size` (device_id, bucket) keys"""
+        cursor = db.sensor_readings.aggregate(self.summary_pipeline(from_time, to_time, frequency), allowDiskUse=True)
+        summaries = {}
+        async for group in cursor:
+            summary = {"count": group["count"]}
+            for metric in SENSOR_METRICS:
+                summary[metric] = {field: float(group[f"{metric}_{field}"]) for field in ("sum", "sumsq", "min", "max")}
+            summaries[(group["_id"]["device_id"], as_utc(group["_id"]["bucket"]))] = summary
+            if len(summaries) >= batch_size:
+                yield summaries
+                summaries = {}
+        if summaries:
+            yield summaries
+
+    def expires_at(self, resolution: str, bucket: datetime) -> Optional[datetime]:
+        seconds = self.retention.get(resolution)
+        if not seconds:
+            return None
+        return bucket + pd.Timedelta(ROLLUP_RESOLUTIONS[resolution]).to_pytimedelta() + timedelta(seconds=seconds)
+
+    async def apply(self, readings: List[dict]):
+        if not readings:
+            return
+        frame = pd.DataFrame(readings, columns=["device_id", "timestamp", *SENSOR_METRICS])
+        frame["timestamp"] = pd.to_datetime(frame["timestamp"], utc=True)
+        operations = []
+        for resolution, frequency in ROLLUP_RESOLUTIONS.items():
+            for (device_id, bucket), summary in self.summarize(frame, frequency).items():
+                increments = {"count": summary["count"]}
+                minimums = {}
+                maximums = {}
+                for metric in SENSOR_METRICS:
+                    increments[f"{metric}.sum"] = summary[metric]["sum"]
+                    increments[f"{metric}.sumsq"] = summary[metric]["sumsq"]
+                    minimums[f"{metric}.min"] = summary[metric]["min"]
+                    maximums[f"{metric}.max"] = summary[metric]["max"]
+                update = {"$inc": increments, "$min": minimums, "$max": maximums}
+                expires_at = self.expires_at(resolution, bucket)
+                if expires_at:
+                    update["$set"] = {"expires_at": expires_at}
+                operations.append(UpdateOne(
+                    {"device_id": device_id, "resolution": resolution, "bucket": bucket},
+                    update,
+                    upsert=True
+                ))
+        await db.sensor_rollups.bulk_write(operations, ordered=False)
+        self.upserts += len(operations)
+
+    def mark_stale(self, readings: List[dict]):
+        """Remember the minutes of readings that were stored without reaching their rollups"""
+        if not readings:
+            return
+        timestamps = pd.to_datetime([reading["timestamp"] for reading in readings], utc=True)
+        self.stale.append((timestamps.min().floor("1min").to_pydatetime(),
+                           (timestamps.max().floor("1min") + pd.Timedelta("1min")).to_pydatetime()))
+
+    async def repair(self, settle: float) -> int:
+        """Compact stale ranges once no write for them can still be in flight"""
+        horizon = datetime.now(timezone.utc) - timedelta(seconds=settle)
+        rebuilt = 0
+        for stale in [stale for stale in self.stale if stale[1] <= horizon]:
+            rebuilt += await self.compact(*stale)
+            self.stale.remove(stale)
+        return rebuilt
+
+    async def backfill(self, window: timedelta = timedelta(days=1)) -> int:
+        """Build rollups for readings stored before rollups were maintained, once.
+
+        The cut-over is the first startup with rollups, recorded in rollup_state so every
+        worker and restart agrees on it. Progress is saved after each window, so an
+        interrupted backfill resumes where it stopped.
+        """
+        cutover = pd.Timestamp(datetime.now(timezone.utc)).ceil("1min").to_pydatetime()
+        await db.rollup_state.update_one({"_id": "backfill"}, {"$setOnInsert": {"until": cutover}}, upsert=True)
+        state = await db.rollup_state.find_one({"_id": "backfill"})
+        self.backfill_until = as_utc(state["until"])
+        if state.get("through"):
+            start = as_utc(state["through"])
+        else:
+            first = await db.sensor_readings.find({}, {"_id": 0, "timestamp": 1}).sort("timestamp", 1).limit(1).to_list(1)
+            if not first:
+                start = self.backfill_until
+            else:
+                start = pd.Timestamp(as_utc(first[0]["timestamp"])).floor("1D").to_pydatetime()
+        rebuilt = 0
+        while start < self.backfill_until:
+            end = min(start + window, self.backfill_until)
+            rebuilt += await self.compact(start, end)
+            await db.rollup_state.update_one({"_id": "backfill"}, {"$max": {"through": end}})
+            self.backfilled_through = start = end
+        self.backfilled_through = self.backfill_until
+        if rebuilt:
+            logging.info(f"Rollup backfill rebuilt {rebuilt} rollups before {self.backfill_until}")
+        return rebuilt
+
+    def replacement(self, device_id: str, resolution: str, bucket: datetime, summary: dict) -> ReplaceOne:
+        document = {"device_id": device_id, "resolution": resolution, "bucket": bucket, **summary}
+        expires_at = self.expires_at(resolution, bucket)
+        if expires_at:
+            document["expires_at"] = expires_at
+        return ReplaceOne({"device_id": device_id, "resolution": resolution, "bucket": bucket}, document, upsert=True)
+
+    async def replace_stale(self, resolution: str, summaries: Dict[tuple, dict]) -> set:
+        """Replace the rollups that hold fewer readings than `summaries`, returning their keys"""
+        buckets = [bucket for _, bucket in summaries]
+        existing = db.sensor_rollups.find(
+            {"resolution": resolution, "device_id": {"$in": list({device_id for device_id, _ in summaries})},
+             "bucket": {"$gte": min(buckets), "$lte": max(buckets)}},
+            {"_id": 0, "device_id": 1, "bucket": 1, "count": 1}
+        )
+        counts = {(rollup["device_id"], as_utc(rollup["bucket"])): rollup["count"] async for rollup in existing}
+        stale = {key for key, summary in summaries.items() if summary["count"] > counts.get(key, 0)}
+        if stale:
+            await db.sensor_rollups.bulk_write(
+                [self.replacement(device_id, resolution, bucket, summaries[(device_id, bucket)]) for device_id, bucket in stale],
+                ordered=False
+            )
+        return stale
+
+    def coarser_pipeline(self, finer: str, resolution: str, device_ids: List[str],
+                         from_time: datetime, to_time: datetime) -> List[dict]:
+        """Rebuild `resolution` buckets in [from_time, to_time) from the `finer` tier, merged back
+        in place of any bucket that holds fewer readings"""
+        length = pd.Timedelta(ROLLUP_RESOLUTIONS[resolution])
+        group = {
+            "_id": {
+                "device_id": "$device_id",
+                "bucket": {"$dateTrunc": {"date": "$bucket", "unit": "second", "binSize": int(length.total_seconds())}}
+            },
+            "count": {"$sum": "$count"}
+        }
+        document = {"_id": 0, "device_id": "$_id.device_id", "resolution": {"$literal": resolution},
+                    "bucket": "$_id.bucket", "count": 1}
+        for metric in SENSOR_METRICS:
+            for field, accumulator in (("sum", "$sum"), ("sumsq", "$sum"), ("min", "$min"), ("max", "$max")):
+                group[f"{metric}_{field}"] = {accumulator: f"${metric}.{field}"}
+            document[metric] = {field: f"${metric}_{field}" for field in ("sum", "sumsq", "min", "max")}
+        retention = self.retention.get(resolution)
+        if retention:
+            document["expires_at"] = {"$dateAdd": {
+                "startDate": "$_id.bucket", "unit": "millisecond",
+                "amount": int((length.total_seconds() + retention) * 1000)
+            }}
+        return [
+            {"$match": {"resolution": finer, "device_id": {"$in": device_ids}, "bucket": {"$gte": from_time, "$lt": to_time}}},
+            {"$group": group},
+            {"$project": document},
+            {"$merge": {
+                "into": "sensor_rollups",
+                "on": ["device_id", "resolution", "bucket"],
+                "whenMatched": [{"$replaceWith": {"$cond": [
+                    {"$gt": ["$$new.count", "$count"]}, {"$mergeObjects": ["$$new", {"_id": "$_id"}]}, "$$ROOT"
+                ]}}],
+                "whenNotMatched": "insert"
+            }}
+        ]
+
+    async def compact(self, from_time: datetime, to_time: datetime) -> int:
+        """Rebuild rollups of raw readings in [from_time, to_time) that never reached them.
+
+        The finest resolution is rebuilt from raw readings, and each coarser one from
+        the tier below it. Rollups are only ever raised: a bucket with fewer raw
+        readings than rolled up has already started to expire.
+        """
+        resolutions = list(ROLLUP_RESOLUTIONS)
+        finest = resolutions[0]
+        # Raw readings are grouped in the database and stream back one batch of summaries at a time
+        stale = set()
+        async for summaries in self.stored_summaries(from_time, to_time, ROLLUP_RESOLUTIONS[finest]):
+            stale |= await self.replace_stale(finest, summaries)
+        rebuilt = len(stale)
+        
+        # Each coarser tier is regrouped and merged in the database, one aggregation per tier
+        for finer, resolution in zip(resolutions, resolutions[1:]):
+            if not stale:
+                break
+            frequency = ROLLUP_RESOLUTIONS[resolution]
+            stale = {(device_id, pd.Timestamp(bucket).floor(frequency).to_pydatetime()) for device_id, bucket in stale}
+            buckets = [bucket for _, bucket in stale]
+            await db.sensor_rollups.aggregate(self.coarser_pipeline(
+                finer, resolution, sorted({device_id for device_id, _ in stale}),
+                min(buckets), max(buckets) + pd.Timedelta(frequency).to_pytimedelta()
+            )).to_list(None)
+            rebuilt += len(stale)
+        self.rebuilt += rebuilt
+        return rebuilt
+
+    @staticmethod
+    def resolution_for(frequency: str) -> Optional[str]:
+        # Largest rollup resolution that evenly divides the requested bucket
+        bucket_seconds = pd.Timedelta(frequency).total_seconds()
+        for resolution in reversed(list(ROLLUP_RESOLUTIONS)):
+            resolution_seconds = pd.Timedelta(ROLLUP_RESOLUTIONS[resolution]).total_seconds()
+            if bucket_seconds % resolution_seconds == 0:
+                return resolution
+        return None
+
+    async def load_frame(self, resolution: str, device_id: Optional[str] = None,
+                         from_time: Optional[datetime] = None, to_time: Optional[datetime] = None,
+                         metrics: List[str] = SENSOR_METRICS) -> pd.DataFrame:
+        query = {"resolution": resolution}
+        if device_id:
+            query["device_id"] = device_id
+        if from_time:
+            frequency = ROLLUP_RESOLUTIONS[resolution]
+            query["bucket"] = {"$gte": pd.Timestamp(from_time).floor(frequency).to_pydatetime()}
+        if to_time:
+            query.setdefault("bucket", {})["$lte"] = to_time
+        projection = {"_id": 0, "device_id": 1, "bucket": 1, "count": 1, **{metric: 1 for metric in metrics}}
+        rollups = await db.sensor_rollups.find(query, projection).sort("bucket", 1).to_list(None)
+        rows = []
+        for rollup in rollups:
+            row = {"device_id": rollup["device_id"], "timestamp": rollup["bucket"], "count": rollup["count"]}
+            for metric in metrics:
+                for field in ("sum", "sumsq", "min", "max"):
+                    row[f"{metric}_{field}"] = rollup[metric][field]
+            rows.append(row)
+        columns = ["device_id", "timestamp", "count"] + [f"{metric}_{field}" for metric in metrics for field in ("sum", "sumsq", "min", "max")]
+        return pd.DataFrame(rows, columns=columns)
+
+    @staticmethod
+    def aggregate(frame: pd.DataFrame, frequency: str, aggregates: List[str],
+                  metrics: List[str] = SENSOR_METRICS) -> List[dict]:
+        points = []
+        combine = {"count": "sum"}
+        for metric in metrics:
+            combine.update({f"{metric}_sum": "sum", f"{metric}_min": "min", f"{metric}_max": "max"})
+        for device_id, group in frame.groupby("device_id", sort=False):
+            merged = group.set_index("timestamp").resample(frequency).agg(combine)
+            merged = merged[merged["count"] > 0]
+            columns = {"count": merged["count"].astype(int)}
+            for aggregate in aggregates:
+                for metric in metrics:
+                    if aggregate == "avg":
+                        values = merged[f"{metric}_sum"] / merged["count"]
+                    else:
+                        values = merged[f"{metric}_{aggregate}"]
+                    columns[f"{metric}_{aggregate}"] = values.round(3)
+            table = pd.DataFrame(columns).reset_index()
+            table["timestamp"] = isoformat_utc(table["timestamp"])
+            table.insert(0, "device_id", device_id)
+            points.extend(table.to_dict("records"))
+        return points
+
+    def stats(self) -> dict:
+        return {
+            "upserts": self.upserts,
+            "rebuilt": self.rebuilt,
+            "stale_ranges": len(self.stale),
+            "backfilled_through": self.backfilled_through,
+            "backfill_until": self.backfill_until
+        }
+
+reading_rollups = ReadingRollups()
+
+# Write-behind buffer between producers and Mongo
+class WriteBehindBuffer:
+    def __init__(self, max_size: int = 10000, batch_size: int = 500, flush_interval_ms: float = 200,
+                 max_attempts: int = 8, retry_backoff_ms: float = 250, max_retry_backoff_ms: float = 30000):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff_ms / 1000
+        self.max_retry_backoff = max_retry_backoff_ms / 1000
+        self.task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.failed = 0  # rejected by the server (e.g. validation), never retried
+        self.dropped = 0  # given up on after max_attempts transient failures
+        self.retries = 0
+        self.flushes = 0
+        # High-water marks: items ever accepted, and the prefix of them a flush has finished with.
+        # Producers enqueue one at a time, so sequence numbers follow queue order.
+        self.accepted = 0
+        self.completed = 0
+        self.put_lock = asyncio.Lock()
+        # Held for a whole flush, so readers can see Mongo exactly as of `completed`
+        self.flush_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        # Items accepted but not yet written (queued or in the current flush)
+        return self.accepted - self.completed
+
+    async def put(self, collection_name: str, document: dict) -> int:
+        return await self.put_many(collection_name, [document])
+
+    async def put_many(self, collection_name: str, documents: list) -> int:
+        """Queue documents, returning the sequence number of the last one.
+
+        Blocks when the queue is full, which applies backpressure to producers.
+        """
+        async with self.put_lock:
+            for document in documents:
+                await self.queue.put((collection_name, document))
+                self.accepted += 1
+            return self.accepted
+
+    async def with_retries(self, description: str, operation):
+        """Await `operation(attempt)`, backing off between transient failures.
+
+        Per-document errors (BulkWriteError) are final and raised at once. Anything else (a
+        dropped connection, failover, timeout) is retried; the flusher waits meanwhile, so a
+        full queue pushes back on producers instead of losing accepted writes.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await operation(attempt)
+            except BulkWriteError:
+                raise
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = min(self.retry_backoff * 2 ** (attempt - 1), self.max_retry_backoff)
+                logging.warning(f"{description} failed (attempt {attempt}/{self.max_attempts}), retrying in {delay:.2f}s: {e}")
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def write(self, batch: List[tuple]):
+        # Items are either documents to insert or pymongo write models (e.g. UpdateOne)
+        async with self.flush_lock:
+            by_collection: Dict[str, tuple] = {}
+            for collection_name, item in batch:
+                documents, operations = by_collection.setdefault(collection_name, ([], []))
+                (documents if isinstance(item, dict) else operations).append(item)
+            for collection_name, (documents, operations) in by_collection.items():
+                collection = db[collection_name]
+                try:
+                    failed = set(await self.with_retries(
+                        f"Write-behind flush to {collection_name}",
+                        lambda attempt: insert_many_unordered(collection, documents) if attempt == 1 else insert_missing(collection, documents)
+                    ))
+                    self.failed += len(failed)
+                except Exception as e:
+                    logging.error(f"Write-behind flush to {collection_name} dropped {len(documents)} documents after {self.max_attempts} attempts: {e}")
+                    failed = set(range(len(documents)))
+                    self.dropped += len(documents)
+                self.written += len(documents) - len(failed)
+                if operations:
+                    # Updates run after the inserts of the same flush, which they may target. They are
+                    # $inc counters, so a re-run after an error that hid a successful write would count
+                    # twice: only the driver's retryable write, which the server deduplicates, retries them.
+                    try:
+                        await collection.bulk_write(operations, ordered=False)
+                        self.written += len(operations)
+                    except BulkWriteError as e:
+                        errors = len(e.details.get('writeErrors', []))
+                        logging.error(f"Write-behind update flush to {collection_name} rejected {errors} operations")
+                        self.written += len(operations) - errors
+                        self.failed += errors
+                    except Exception as e:
+                        logging.error(f"Write-behind update flush to {collection_name} dropped {len(operations)} operations: {e}")
+                        self.dropped += len(operations)
+                if collection_name == "sensor_readings":
+                    stored = [document for index, document in enumerate(documents) if index not in failed]
+                    try:
+                        await reading_rollups.apply(stored)
+                    except Exception as e:
+                        logging.error(f"Rollup update failed, queued for repair: {e}")
+                        reading_rollups.mark_stale(stored)
+            self.flushes += 1
+            self.completed += len(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.write(batch)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Let the flusher drain everything still queued before cancelling it
+        if self.task:
+            await self.queue.join()
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        elif not self.queue.empty():
+            batch = []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "pending": self.pending,
+            "max_size": self.queue.maxsize,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "flushes": self.flushes
+        }
+
+write_buffer = WriteBehindBuffer(
+    max_size=int(os.environ.get('WRITE_BUFFER_MAX_SIZE', 10000)),
+    batch_size=int(os.environ.get('WRITE_BUFFER_BATCH_SIZE', 500)),
+    flush_interval_ms=float(os.environ.get('WRITE_BUFFER_FLUSH_MS', 200)),
+    max_attempts=int(os.environ.get('WRITE_BUFFER_MAX_ATTEMPTS', 8)),
+    retry_backoff_ms=float(os.environ.get('WRITE_BUFFER_RETRY_BACKOFF_MS', 250)),
+    max_retry_backoff_ms=float(os.environ.get('WRITE_BUFFER_MAX_RETRY_BACKOFF_MS', 30000))
+)
+
+# Storage layout: collections, indexes and query plan checks
+async def server_version() -> tuple:
+    try:
+        return tuple((await client.server_info())["versionArray"][:2])
+    except Exception as e:
+        logging.warning(f"Could not read the MongoDB server version ({e})")
+        return (0, 0)
+
+async def ensure_storage_layout():
+    existing = await db.list_collection_names()
+    version = await server_version()
+    if 'sensor_readings' not in existing and version < (6, 0):
+        # 5.0 time-series collections cannot index measurement fields such as id
+        logging.warning(f"MongoDB {'.'.join(map(str, version))} predates secondary indexes on time-series measurements, using a regular sensor_readings collection")
+    elif 'sensor_readings' not in existing:
+        try:
+            await db.create_collection(
+                'sensor_readings',
+                timeseries={'timeField': 'timestamp', 'metaField': 'device_id', 'granularity': 'seconds'}
+            )
+            logging.info("Created sensor_readings as a time-series collection")
+        except Exception as e:
+            logging.warning(f"Time-series collections unavailable ({e}), using a regular sensor_readings collection")
+    
+    # Reading indexes end in id so keyset pages over (timestamp, id) come straight off the index
+    try:
+        await db.sensor_readings.create_index([("device_id", 1), ("timestamp", -1), ("id", -1)])
+        await db.sensor_readings.create_index([("timestamp", -1), ("id", -1)])
+    except OperationFailure as e:
+        # A time-series collection created on MongoDB 5.0 only takes meta and time fields
+        logging.warning(f"Cannot index sensor_readings on id ({e}), keyset pages will sort ties in memory")
+        await db.sensor_readings.create_index([("device_id", 1), ("timestamp", -1)])
+        await db.sensor_readings.create_index([("timestamp", -1)])
+    await db.sensor_rollups.create_index([("device_id", 1), ("resolution", 1), ("bucket", 1)], unique=True)
+    await db.sensor_rollups.create_index([("resolution", 1), ("bucket", 1)])
+    # Alert indexes end in id so keyset pages over (timestamp, id) stay index-only
+    await db.alerts.create_index([("acknowledged", 1), ("timestamp", -1), ("id", -1)])
+    await db.alerts.create_index([("device_id", 1), ("timestamp", -1), ("id", -1)])
+    await db.alerts.create_index([("timestamp", -1), ("id", -1)])
+    await db.alerts.create_index("id", unique=True)
+    await db.detector_state.create_index("device_id", unique=True)
+    await db.threshold_overrides.create_index([("device_id", 1), ("device_type", 1), ("metric", 1)], unique=True)
+    await db.devices.create_index("id", unique=True)
+    await db.users.create_index("username", unique=True)
+
+def find_collscans(explain_doc) -> List[str]:
+    # Only the winning plans matter; rejected plans may legitimately contain COLLSCAN
+    stages = []
+    def walk(node, in_winning_plan):
+        if isinstance(node, dict):
+            if in_winning_plan and node.get('stage') == 'COLLSCAN':
+                stages.append(json.dumps(node.get('filter', {}), default=str))
+            for key, value in node.items():
+                if key == 'rejectedPlans':
+                    continue
+                walk(value, in_winning_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, in_winning_plan)
+    walk(explain_doc, False)
+    return stages
+
+async def verify_query_plans(mode: str = "warn"):
+    if mode == "off":
+        return
+    try:
+        timeseries = "timeseries" in await db.sensor_readings.options()
+    except Exception:
+        timeseries = False
+    now = datetime.now(timezone.utc)
+    # name -> (cursor, whether a COLLSCAN fails strict mode)
+    hot_queries = {
+        "metrics by device and time range": (db.sensor_readings.find(
+            {"device_id": "plan-check", "timestamp": {"$gte": now - timedelta(hours=1), "$lte": now}}
+        ).sort(KEYSET_SORT).limit(1000), True),
+        # Unfiltered reads of a time-series collection unpack buckets rather than walk a
+        # document index, so a bucket scan there is expected and only reported
+        "latest readings": (db.sensor_readings.find().sort(KEYSET_SORT).limit(10), not timeseries),
+        "active alerts": (db.alerts.find({"acknowledged": False}).sort(KEYSET_SORT).limit(100), True),
+        "alerts by device": (db.alerts.find({"device_id": "plan-check"}).sort(KEYSET_SORT).limit(100), True),
+    }
+    offenders = []
+    notes = []
+    for name, (cursor, required) in hot_queries.items():
+        try:
+            collscans = find_collscans(await cursor.explain())
+        except Exception as e:
+            collscans = [f"explain failed ({e})"]
+        if collscans:
+            (offenders if required else notes).append(f"{name}: {', '.join(collscans)}")
+    if notes:
+        logging.info("Expected scans on the time-series layout: " + "; ".join(notes))
+    if offenders:
+        message = "Hot queries are doing collection scans: " + "; ".join(offenders)
+        if mode == "strict":
+            raise RuntimeError(message)
+        logging.warning(message)
+
+# Retention: raw readings, rollup tiers and acknowledged alerts expire through TTL
+DAY_SECONDS = 86400
+
+class RetentionManager:
+    def __init__(self, readings_days: float = 0, rollup_days: Optional[Dict[str, float]] = None,
+                 acknowledged_alert_days: float = 0, compaction_interval: float = 600, compaction_lead: float = 300,
+                 rollup_settle: float = 120):
+        self.readings_seconds = readings_days * DAY_SECONDS
+        self.rollup_seconds = self.tier_retention({
+            resolution: days * DAY_SECONDS for resolution, days in (rollup_days or {}).items()
+        })
+        self.acknowledged_alert_seconds = acknowledged_alert_days * DAY_SECONDS
+        self.compaction_interval = compaction_interval
+        # Raw readings are compacted this long before the TTL monitor can reach them
+        self.compaction_lead = compaction_lead
+        # Rollups are only rebuilt for minutes this old, so no live write to them is still in flight
+        self.rollup_settle = rollup_settle
+        self.task: Optional[asyncio.Task] = None
+        self.backfill_task: Optional[asyncio.Task] = None
+        self.compactions = 0
+        self.last_compaction: Optional[datetime] = None
+        reading_rollups.retention = self.rollup_seconds
+
+    def tier_retention(self, configured: Dict[str, float]) -> Dict[str, float]:
+        """Each tier must outlive the one below it by a bucket of the tier above,
+        so coarser rollups can still be rebuilt when raw readings expire"""
+        effective = {}
+        previous = self.readings_seconds
+        resolutions = list(ROLLUP_RESOLUTIONS)
+        for index, resolution in enumerate(resolutions):
+            seconds = configured.get(resolution, 0)
+            if seconds and previous:
+                coarser = resolutions[index + 1] if index + 1 < len(resolutions) else None
+                minimum = previous + (pd.Timedelta(ROLLUP_RESOLUTIONS[coarser]).total_seconds() if coarser else 0)
+                if seconds < minimum:
+                    logging.warning(f"{resolution} rollup retention raised to {minimum / DAY_SECONDS:.2f} days to cover the tier below")
+                    seconds = minimum
+            else:
+                # A tier below that is kept forever keeps this one forever too
+                seconds = 0
+            effective[resolution] = seconds
+            previous = seconds
+        return effective
+
+    @staticmethod
+    async def ensure_ttl_index(collection, field: str, direction: int, seconds: float):
+        try:
+            await collection.create_index([(field, direction)], expireAfterSeconds=int(seconds))
+        except OperationFailure:
+            # The index exists with other options; change its expiry in place
+            await db.command("collMod", collection.name,
+                             index={"keyPattern": {field: direction}, "expireAfterSeconds": int(seconds)})
+
+    @staticmethod
+    async def drop_ttl_index(collection, field: str):
+        # A TTL index cannot be switched off in place, so a retention of 0 drops it
+        for name, index in (await collection.index_information()).items():
+            if "expireAfterSeconds" in index and [key for key, _ in index["key"]] == [field]:
+                await collection.drop_index(name)
+                logging.info(f"Dropped TTL index {name} on {collection.name}, its documents are kept forever")
+
+    async def apply_policies(self):
+        try:
+            options = await db.sensor_readings.options()
+            if "timeseries" in options:
+                await db.command("collMod", "sensor_readings",
+                                 expireAfterSeconds=int(self.readings_seconds) if self.readings_seconds else "off")
+            elif self.readings_seconds:
+                await self.ensure_ttl_index(db.sensor_readings, "timestamp", -1, self.readings_seconds)
+            else:
+                await self.drop_ttl_index(db.sensor_readings, "timestamp")
+        except Exception as e:
+            logging.warning(f"Raw reading retention unavailable ({e}), sensor_readings will not expire")
+        try:
+            # Each rollup carries its own expiry, stamped from its resolution's retention
+            await self.ensure_ttl_index(db.sensor_rollups, "expires_at", 1, 0)
+            if self.acknowledged_alert_seconds:
+                # Alerts acknowledged before acknowledged_at existed start their retention now
+                await db.alerts.update_many(
+                    {"acknowledged": True, "acknowledged_at": None},
+                    {"$set": {"acknowledged_at": datetime.now(timezone.utc)}}
+                )
+                await self.ensure_ttl_index(db.alerts, "acknowledged_at", 1, self.acknowledged_alert_seconds)
+            else:
+                await self.drop_ttl_index(db.alerts, "acknowledged_at")
+        except Exception as e:
+            logging.warning(f"Retention TTL indexes unavailable ({e})")
+
+    async def compact(self) -> int:
+        if not self.readings_seconds:
+            return 0
+        # Overlapping windows: every minute is reconciled at least once before it expires
+        start = pd.Timestamp(datetime.now(timezone.utc) - timedelta(seconds=self.readings_seconds - self.compaction_lead)).floor("1min")
+        end = (start + pd.Timedelta(seconds=2 * self.compaction_interval)).ceil("1min")
+        rebuilt = await reading_rollups.compact(start.to_pydatetime(), end.to_pydatetime())
+        self.compactions += 1
+        self.last_compaction = datetime.now(timezone.utc)
+        if rebuilt:
+            logging.info(f"Compaction rebuilt {rebuilt} rollups between {start} and {end}")
+        return rebuilt
+
+    async def backfill(self):
+        # Runs whatever the retention settings, so history from before rollups existed is bucketed too
+        await asyncio.sleep(self.rollup_settle)
+        try:
+            await reading_rollups.backfill()
+        except Exception as e:
+            logging.error(f"Rollup backfill error: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            try:
+                await reading_rollups.repair(self.rollup_settle)
+                await self.compact()
+            except Exception as e:
+                logging.error(f"Retention compaction error: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        if self.backfill_task is None:
+            self.backfill_task = asyncio.create_task(self.backfill())
+
+    async def stop(self):
+        for task in (self.task, self.backfill_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self.backfill_task = None
+
+    @staticmethod
+    async def collection_stats(name: str) -> dict:
+        try:
+            stats = await db.command("collStats", name)
+            documents = stats.get("count")
+            sizes = {"size_bytes": stats.get("size"), "storage_bytes": stats.get("storageSize"),
+                     "index_bytes": stats.get("totalIndexSize")}
+        except Exception:
+            documents = None
+            sizes = {"size_bytes": None, "storage_bytes": None, "index_bytes": None}
+        if documents is None:
+            # Time-series collections report buckets, not measurements; an estimate is enough here
+            documents = await db[name].estimated_document_count()
+        if sizes["size_bytes"] is None and documents:
+            # Estimate from a sample document
+            sample = await db[name].find_one()
+            sizes["size_bytes"] = len(bson.encode(sample)) * documents
+        return {"documents": documents, **sizes}
+
+    async def storage_report(self) -> dict:
+        collections = {name: await self.collection_stats(name) for name in ("sensor_readings", "sensor_rollups", "alerts")}
+        now = datetime.now(timezone.utc)
+        readings_per_second = await db.sensor_readings.count_documents({"timestamp": {"$gte": now - timedelta(hours=1)}}) / 3600
+        alerts_per_second = await db.alerts.count_documents({"timestamp": {"$gte": now - timedelta(days=1)}}) / DAY_SECONDS
+        # Devices that actually report, simulator devices included, from the (resolution, bucket) index
+        reporting = await db.sensor_rollups.aggregate([
+            {"$match": {"resolution": "1h", "bucket": {"$gte": now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)}}},
+            {"$group": {"_id": "$device_id"}},
+            {"$count": "devices"}
+        ]).to_list(1)
+        reporting_devices = reporting[0]["devices"] if reporting else 0
+        
+        def bytes_per_document(name: str) -> Optional[float]:
+            stats = collections[name]
+            if not stats["documents"] or stats["size_bytes"] is None:
+                return None
+            return stats["size_bytes"] / stats["documents"]
+        
+        def project(documents: float, size: Optional[float]) -> Optional[int]:
+            return int(documents * size) if size is not None else None
+        
+        # Steady state: what the current rates occupy once every tier has filled its retention window
+        projected = {
+            "sensor_readings": project(readings_per_second * self.readings_seconds, bytes_per_document("sensor_readings"))
+            if self.readings_seconds else None,
+            "sensor_rollups": None,
+            "acknowledged_alerts": project(alerts_per_second * self.acknowledged_alert_seconds, bytes_per_document("alerts"))
+            if self.acknowledged_alert_seconds else None
+        }
+        if all(self.rollup_seconds.values()):
+            # Upper bound: every reporting device reports in every bucket
+            rollup_documents = sum(
+                reporting_devices * seconds / pd.Timedelta(ROLLUP_RESOLUTIONS[resolution]).total_seconds()
+                for resolution, seconds in self.rollup_seconds.items()
+            )
+            projected["sensor_rollups"] = project(rollup_documents, bytes_per_document("sensor_rollups"))
+        values = list(projected.values())
+        projected["total"] = sum(values) if all(value is not None for value in values) else None
+        return {
+            "collections": collections,
+            "rates": {
+                "readings_per_second": round(readings_per_second, 3),
+                "alerts_per_second": round(alerts_per_second, 6),
+                "reporting_devices": reporting_devices
+            },
+            "retention_days": self.stats()["retention_days"],
+            "projected_steady_state_bytes": projected
+        }
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": {
+                "sensor_readings": self.readings_seconds / DAY_SECONDS,
+                **{f"rollups_{resolution}": seconds / DAY_SECONDS for resolution, seconds in self.rollup_seconds.items()},
+                "acknowledged_alerts": self.acknowledged_alert_seconds / DAY_SECONDS
+            },
+            "compactions": self.compactions,
+            "last_compaction": self.last_compaction
+        }
+
+retention_manager = RetentionManager(
+    readings_days=float(os.environ.get('READINGS_RETENTION_DAYS', 0)),
+    rollup_days={
+        '1m': float(os.environ.get('ROLLUP_1M_RETENTION_DAYS', 60)),
+        '1h': float(os.environ.get('ROLLUP_1H_RETENTION_DAYS', 730)),
+        '1d': float(os.environ.get('ROLLUP_1D_RETENTION_DAYS', 0))
+    },
+    acknowledged_alert_days=float(os.environ.get('ACKNOWLEDGED_ALERT_RETENTION_DAYS', 0)),
+    compaction_interval=float(os.environ.get('RETENTION_COMPACTION_SECONDS', 600)),
+    rollup_settle=float(os.environ.get('ROLLUP_REPAIR_SETTLE_SECONDS', 120))
+)
+
+# Alert deduplication and storm suppression
+def as_utc(value: datetime) -> datetime:
+    # Mongo hands back naive UTC datetimes
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+class AlertCoalescer:
+    def __init__(self, window: float = 300):
+        self.window = timedelta(seconds=window)
+        self.open: Dict[tuple, dict] = {}
+        self.keys_by_id: Dict[str, tuple] = {}
+        self.created = 0
+        self.coalesced = 0
+        self.last_pruned = datetime.now(timezone.utc)
+
+    def close(self, alert_id: str):
+        key = self.keys_by_id.pop(alert_id, None)
+        if key is not None:
+            self.open.pop(key, None)
+
+    async def close_acknowledged(self, device_id: Optional[str] = None, metric: Optional[str] = None,
+                                 severity: Optional[str] = None, alert_ids: Optional[List[str]] = None):
+        """Close the open alerts matching a bulk acknowledgement that Mongo now has acknowledged"""
+        candidates = self.open_ids(device_id, metric, severity)
+        if alert_ids is not None:
+            candidates = list(set(candidates) & set(alert_ids))
+        if not candidates:
+            return
+        closed = await db.alerts.find({"id": {"$in": candidates}, "acknowledged": True}, {"_id": 0, "id": 1}).to_list(None)
+        for alert in closed:
+            self.close(alert["id"])
+
+    def open_ids(self, device_id: Optional[str] = None, metric: Optional[str] = None,
+                 severity: Optional[str] = None) -> List[str]:
+        return [
+            entry["id"] for (key_device, _, key_metric, key_severity), entry in self.open.items()
+            if (device_id is None or key_device == device_id)
+            and (metric is None or key_metric == metric)
+            and (severity is None or key_severity == severity)
+        ]
+
+    def coalesce(self, alerts: List[Alert]) -> tuple:
+        """Split alerts into new ones and UpdateOne operations for repeats of open alerts"""
+        new_alerts = []
+        repeats: Dict[str, dict] = {}
+        for alert in alerts:
+            key = (alert.device_id, alert.alert_type, alert.metric, alert.severity)
+            entry = self.open.get(key)
+            if entry and alert.timestamp - entry["last_seen"] <= self.window:
+                entry["last_seen"] = alert.timestamp
+                repeat = repeats.setdefault(entry["id"], {"count": 0, "last_seen": alert.timestamp})
+                repeat["count"] += 1
+                repeat["last_seen"] = max(repeat["last_seen"], alert.timestamp)
+                continue
+            if entry:
+                self.keys_by_id.pop(entry["id"], None)
+            alert.last_seen = alert.timestamp
+            self.open[key] = {"id": alert.id, "last_seen": alert.timestamp}
+            self.keys_by_id[alert.id] = key
+            new_alerts.append(alert)
+        
+        self.created += len(new_alerts)
+        self.coalesced += sum(repeat["count"] for repeat in repeats.values())
+        updates = [
+            UpdateOne({"id": alert_id}, {"$inc": {"occurrences": repeat["count"]}, "$max": {"last_seen": repeat["last_seen"]}})
+            for alert_id, repeat in repeats.items()
+        ]
+        return new_alerts, updates
+
+    async def record(self, alerts: List[Alert]) -> List[Alert]:
+        """Queue new alerts and repeat counters for storage, returning only the new alerts"""
+        if datetime.now(timezone.utc) - self.last_pruned > self.window:
+            self.prune()
+        new_alerts, updates = self.coalesce(alerts)
+        sequence = await write_buffer.put_many("alerts", [alert.dict() for alert in new_alerts])
+        await write_buffer.put_many("alerts", updates)
+        dashboard_summary.alerts_opened(len(new_alerts), sequence)
+        return new_alerts
+
+    async def load(self):
+        # Re-open unacknowledged alerts still inside the window so restarts don't duplicate them
+        since = datetime.now(timezone.utc) - self.window
+        alerts = await db.alerts.find(
+            {"acknowledged": False, "$or": [{"last_seen": {"$gte": since}}, {"timestamp": {"$gte": since}}]},
+            {"_id": 0, "id": 1, "device_id": 1, "alert_type": 1, "metric": 1, "severity": 1, "timestamp": 1, "last_seen": 1}
+        ).sort("timestamp", 1).to_list(None)
+        for alert in alerts:
+            key = (alert["device_id"], alert["alert_type"], alert["metric"], alert["severity"])
+            self.open[key] = {"id": alert["id"], "last_seen": as_utc(alert.get("last_seen") or alert["timestamp"])}
+            self.keys_by_id[alert["id"]] = key
+        self.last_pruned = datetime.now(timezone.utc)
+
+    def prune(self):
+        self.last_pruned = datetime.now(timezone.utc)
+        cutoff = self.last_pruned - self.window
+        for key, entry in list(self.open.items()):
+            if entry["last_seen"] < cutoff:
+                self.close(entry["id"])
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self.open),
+            "created": self.created,
+            "coalesced": self.coalesced
+        }
+
+alert_coalescer = AlertCoalescer(window=float(os.environ.get('ALERT_DEDUP_WINDOW_SECONDS', 300)))
+
+# Dashboard summary kept in memory and reconciled against Mongo in the background
+class DashboardSummary:
+    def __init__(self, latest_size: int = 10, reconcile_interval: float = 30, push_interval: float = 5):
+        self.latest: deque = deque(maxlen=latest_size)  # power_kw of the most recent readings
+        self.hourly: Dict[datetime, list] = {}  # hour -> [power_kw sum, reading count]
+        self.active_alerts = 0
+        self.reconcile_interval = reconcile_interval
+        self.push_interval = push_interval
+        # Changes still waiting in the write buffer: (sequence, hour, power_kw sum, reading count,
+        # alerts opened). Mongo has them once write_buffer.completed reaches sequence.
+        self.in_flight: deque = deque()
+        # Bumped on changes written straight to Mongo, so a reconciliation racing one can be discarded
+        self.version = 0
+        self.last_pushed: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.reconciliations = 0
+        self.corrections = 0
+        self.skipped = 0
+
+    def observe_readings(self, power_values: List[float], sequence: int, timestamp: Optional[datetime] = None):
+        """Count readings queued in the write buffer up to `sequence`"""
+        if not power_values:
+            return
+        hour = (timestamp or datetime.now(timezone.utc)).replace(minute=0, second=0, microsecond=0)
+        recent = power_values[-self.latest.maxlen:]
+        self.add_hourly(hour, sum(power_values), len(power_values))
+        self.latest.extend(recent)
+        self.forget_flushed(write_buffer.completed)
+        self.in_flight.append((sequence, hour, sum(power_values), len(power_values), 0))
+
+    def alerts_opened(self, count: int, sequence: int):
+        """Count alerts queued in the write buffer up to `sequence`"""
+        if count:
+            self.active_alerts += count
+            self.in_flight.append((sequence, None, 0.0, 0, count))
+
+    def forget_flushed(self, flushed: int):
+        while self.in_flight and self.in_flight[0][0] <= flushed:
+            self.in_flight.popleft()
+
+    def add_hourly(self, hour: datetime, power_sum: float, count: int):
+        bucket = self.hourly.setdefault(hour, [0.0, 0])
+        bucket[0] += power_sum
+        bucket[1] += count
+
+    def alerts_acknowledged(self, count: int):
+        if count:
+            self.active_alerts = max(self.active_alerts - count, 0)
+            self.version += 1
+
+    def snapshot(self) -> dict:
+        # Same 24h window as the hourly rollups: the current hour plus the 24 before it
+        since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=24)
+        for hour in [hour for hour in self.hourly if hour < since]:
+            del self.hourly[hour]
+        power_sum = sum(bucket[0] for bucket in self.hourly.values())
+        count = sum(bucket[1] for bucket in self.hourly.values())
+        return {
+            "device_count": len(device_registry),
+            "active_alerts": self.active_alerts,
+            "avg_power_kw": round(sum(self.latest) / len(self.latest), 2) if self.latest else 0,
+            "avg_power_kw_24h": round(power_sum / count, 2) if count else 0,
+            "system_status": "operational"
+        }
+
+    async def reconcile(self, lock_timeout: float = 5) -> bool:
+        """Replace the in-memory state with Mongo's as of the write buffer's high-water mark,
+        plus the changes still queued behind it"""
+        version = self.version
+        try:
+            # No flush runs while Mongo is read, so it holds exactly the first `flushed` buffered items
+            await asyncio.wait_for(write_buffer.flush_lock.acquire(), lock_timeout)
+        except asyncio.TimeoutError:
+            # A flush is stuck retrying; try again next interval
+            self.skipped += 1
+            return False
+        try:
+            flushed = write_buffer.completed
+            active_alerts = await db.alerts.count_documents({"acknowledged": False})
+            since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=24)
+            rollups = await db.sensor_rollups.find(
+                {"resolution": "1h", "bucket": {"$gte": since}},
+                {"_id": 0, "bucket": 1, "count": 1, "power_kw.sum": 1}
+            ).to_list(None)
+        finally:
+            write_buffer.flush_lock.release()
+        if version != self.version:
+            self.skipped += 1
+            return False
+        
+        self.forget_flushed(flushed)
+        previous_alerts = self.active_alerts
+        self.hourly = {}
+        for rollup in rollups:
+            self.add_hourly(as_utc(rollup["bucket"]), rollup["power_kw"]["sum"], rollup["count"])
+        # The last-value cache already holds queued readings and other workers' ones, so no query is needed
+        latest = heapq.nlargest(self.latest.maxlen, latest_readings.readings.values(), key=lambda reading: reading["timestamp"])
+        self.latest = deque((reading["power_kw"] for reading in reversed(latest)), maxlen=self.latest.maxlen)
+        self.active_alerts = active_alerts
+        for _, hour, power_sum, count, alerts in self.in_flight:
+            if count:
+                self.add_hourly(hour, power_sum, count)
+            self.active_alerts += alerts
+        if self.active_alerts != previous_alerts:
+            self.corrections += 1
+            logging.info(f"Dashboard summary active alerts corrected from {previous_alerts} to {self.active_alerts}")
+        self.reconciliations += 1
+        return True
+
+    async def push(self):
+        snapshot = self.snapshot()
+        if snapshot != self.last_pushed:
+            # Every worker pushes its own snapshot to its own sockets
+            manager.deliver({"type": "dashboard_summary", "data": snapshot})
+            self.last_pushed = snapshot
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last_reconcile = loop.time()
+        while True:
+            await asyncio.sleep(self.push_interval or self.reconcile_interval)
+            try:
+                if loop.time() - last_reconcile >= self.reconcile_interval:
+                    await self.reconcile()
+                    last_reconcile = loop.time()
+                if self.push_interval:
+                    await self.push()
+            except Exception as e:
+                logging.error(f"Dashboard summary error: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "active_alerts": self.active_alerts,
+            "hours": len(self.hourly),
+            "reconciliations": self.reconciliations,
+            "corrections": self.corrections,
+            "skipped": self.skipped,
+            "in_flight": len(self.in_flight)
+        }
+
+dashboard_summary = DashboardSummary(
+    reconcile_interval=float(os.environ.get('DASHBOARD_RECONCILE_SECONDS', 30)),
+    push_interval=float(os.environ.get('DASHBOARD_PUSH_SECONDS', 5))
+)
+
+# Last-value cache: the newest reading of every device
+class LatestReadings:
+    def __init__(self):
+        self.readings: Dict[str, dict] = {}
+        self.updates = 0
+
+    def update(self, readings: List[dict]):
+        for reading in readings:
+            if reading["timestamp"].tzinfo is None:
+                reading = {**reading, "timestamp": as_utc(reading["timestamp"])}
+            current = self.readings.get(reading["device_id"])
+            # Late or out-of-order batches never replace a newer reading
+            if current is None or reading["timestamp"] >= current["timestamp"]:
+                self.readings[reading["device_id"]] = reading
+        self.updates += len(readings)
+
+    async def load(self):
+        # One index-backed pass: newest reading per device_id
+        readings = await db.sensor_readings.aggregate([
+            {"$sort": {"device_id": 1, "timestamp": -1}},
+            {"$group": {"_id": "$device_id", "reading": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$reading"}},
+            {"$project": {"_id": 0}}
+        ]).to_list(None)
+        self.readings = {}
+        self.update(readings)
+
+    def snapshot(self) -> List[dict]:
+        return [
+            {
+                "device_id": device.id,
+                "name": device.name,
+                "type": device.type,
+                "location": device.location,
+                "status": device.status,
+                "reading": self.readings.get(device.id)
+            }
+            for device in device_registry.all()
+        ]
+
+    def stats(self) -> dict:
+        return {"devices": len(self.readings), "updates": self.updates}
+
+latest_readings = LatestReadings()
+
 # Anomaly Detection Class
+THRESHOLD_METRICS = ['power_kw', 'temperature_c', 'vibration']
+SEVERITY_LEVELS = ['low', 'medium', 'high', 'critical']
+
+class OnlineStatistics:
+    """Welford mean/variance and EWMA per device per metric, stored in growable NumPy arrays"""
+    def __init__(self, z_limit: float = 4.0, warmup: int = 30, alpha: float = 0.05, basis: str = "welford",
+                 snapshot_interval: float = 60, capacity: int = 64):
+        self.z_limit = z_limit
+        self.warmup = warmup
+        self.alpha = alpha
+        self.basis = basis
+        self.snapshot_interval = snapshot_interval
+        self.index: Dict[str, int] = {}
+        self.device_ids: List[str] = []
+        self.dirty: set = set()
+        self.task: Optional[asyncio.Task] = None
+        self.allocate(capacity)
+
+    def allocate(self, capacity: int):
+        metrics = len(THRESHOLD_METRICS)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.mean = np.zeros((capacity, metrics))
+        self.m2 = np.zeros((capacity, metrics))
+        self.ewma = np.zeros((capacity, metrics))
+        self.ewvar = np.zeros((capacity, metrics))
+
+    def rows_for(self, device_ids: List[str]) -> np.ndarray:
+        rows = np.empty(len(device_ids), dtype=np.intp)
+        for position, device_id in enumerate(device_ids):
+            row = self.index.get(device_id)
+            if row is None:
+                row = self.index[device_id] = len(self.device_ids)
+                self.device_ids.append(device_id)
+                if row >= len(self.count):
+                    self.grow()
+            rows[position] = row
+        return rows
+
+    def grow(self):
+        count, mean, m2, ewma, ewvar = self.count, self.mean, self.m2, self.ewma, self.ewvar
+        self.allocate(len(count) * 2)
+        size = len(count)
+        self.count[:size], self.mean[:size], self.m2[:size] = count, mean, m2
+        self.ewma[:size], self.ewvar[:size] = ewma, ewvar
+
+    def update(self, device_ids: List[str], values: np.ndarray) -> tuple:
+        """Score readings against the state before they arrived, then fold them in.
+
+        Returns (z_scores, centers, spreads), each N x metrics; z is NaN while a device warms up.
+        """
+        rows = self.rows_for(device_ids)
+        z_scores = np.full(values.shape, np.nan)
+        centers = np.zeros(values.shape)
+        spreads = np.zeros(values.shape)
+        # A device can appear several times in one batch; apply its readings in arrival order
+        occurrence = np.zeros(len(rows), dtype=np.intp)
+        seen: Dict[int, int] = {}
+        for position, row in enumerate(rows):
+            occurrence[position] = seen.get(row, 0)
+            seen[row] = occurrence[position] + 1
+        for wave in range(int(occurrence.max()) + 1 if len(rows) else 0):
+            positions = np.nonzero(occurrence == wave)[0]
+            self.update_unique(rows[positions], values[positions], positions, z_scores, centers, spreads)
+        self.dirty.update(rows.tolist())
+        return z_scores, centers, spreads
+
+    def update_unique(self, rows, values, positions, z_scores, centers, spreads):
+        count = self.count[rows]
+        warm = count >= self.warmup
+        if self.basis == "ewma":
+            center = self.ewma[rows]
+            spread = np.sqrt(self.ewvar[rows])
+        else:
+            center = self.mean[rows]
+            spread = np.sqrt(self.m2[rows] / np.maximum(count - 1, 1)[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.abs(values - center) / spread
+        z[~warm] = np.nan
+        z[spread == 0] = np.nan
+        z_scores[positions], centers[positions], spreads[positions] = z, center, spread
+        
+        # Welford
+        count = count + 1
+        delta = values - self.mean[rows]
+        mean = self.mean[rows] + delta / count[:, None]
+        self.m2[rows] += delta * (values - mean)
+        self.mean[rows] = mean
+        self.count[rows] = count
+        # EWMA and exponentially weighted variance, seeded by the first reading
+        first = count == 1
+        diff = values - self.ewma[rows]
+        increment = self.alpha * diff
+        ewma = np.where(first[:, None], values, self.ewma[rows] + increment)
+        ewvar = np.where(first[:, None], 0.0, (1 - self.alpha) * (self.ewvar[rows] + diff * increment))
+        self.ewma[rows], self.ewvar[rows] = ewma, ewvar
+
+    def score(self, device_ids: List[str], values: np.ndarray) -> List[Alert]:
+        if len(device_ids) == 0:
+            return []
+        z_scores, centers, spreads = self.update(device_ids, values)
+        breaches = np.nan_to_num(z_scores, nan=0.0) > self.z_limit
+        alerts = []
+        for row, column in zip(*np.nonzero(breaches)):
+            metric = THRESHOLD_METRICS[column]
+            value = float(values[row, column])
+            z = float(z_scores[row, column])
+            direction = 1 if value > centers[row, column] else -1
+            threshold = float(centers[row, column] + direction * self.z_limit * spreads[row, column])
+            alerts.append(Alert(
+                device_id=device_ids[row],
+                alert_type="anomaly_detected",
+                metric=metric,
+                value=value,
+                threshold=threshold,
+                severity=SEVERITY_LEVELS[int(np.digitize(z, [self.z_limit * 1.5, self.z_limit * 2, self.z_limit * 3]))],
+                message=f"{metric} {value:.2f} deviates {z:.1f} standard deviations from its running {self.basis} baseline"
+            ))
+        return alerts
+
+    async def load(self):
+        snapshots = await db.detector_state.find({}, {"_id": 0}).to_list(None)
+        rows = self.rows_for([snapshot["device_id"] for snapshot in snapshots])
+        for row, snapshot in zip(rows, snapshots):
+            self.count[row] = snapshot["count"]
+            self.mean[row], self.m2[row] = snapshot["mean"], snapshot["m2"]
+            self.ewma[row], self.ewvar[row] = snapshot["ewma"], snapshot["ewvar"]
+
+    async def snapshot(self):
+        if not self.dirty:
+            return
+        rows, self.dirty = sorted(self.dirty), set()
+        operations = [
+            ReplaceOne(
+                {"device_id": self.device_ids[row]},
+                {
+                    "device_id": self.device_ids[row],
+                    "count": int(self.count[row]),
+                    "mean": self.mean[row].tolist(),
+                    "m2": self.m2[row].tolist(),
+                    "ewma": self.ewma[row].tolist(),
+                    "ewvar": self.ewvar[row].tolist(),
+                    "updated_at": datetime.now(timezone.utc)
+                },
+                upsert=True
+            )
+            for row in rows
+        ]
+        await db.detector_state.bulk_write(operations, ordered=False)
+
+    async def run_snapshots(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                logging.error(f"Detector state snapshot error: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run_snapshots())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.snapshot()
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self.device_ids),
+            "warm_devices": int((self.count[:len(self.device_ids)] >= self.warmup).sum()),
+            "basis": self.basis,
+            "z_limit": self.z_limit
+        }
+
+class SampleWindow:
+    """Fixed-size ring of the most recent readings, preallocated as a (size, metrics) array"""
+    def __init__(self, size: int, metrics: int):
+        self.values = np.empty((size, metrics))
+        self.position = 0
+        self.filled = 0
+
+    def __len__(self) -> int:
+        return self.filled
+
+    def extend(self, rows: np.ndarray):
+        size = len(self.values)
+        rows = rows[-size:]
+        end = self.position + len(rows)
+        # Copy in at most two slices so no reference to the caller's array is kept
+        head = min(end, size) - self.position
+        self.values[self.position:self.position + head] = rows[:head]
+        self.values[:len(rows) - head] = rows[head:]
+        self.position = end % size
+        self.filled = min(self.filled + len(rows), size)
+
+    def samples(self) -> np.ndarray:
+        if self.filled < len(self.values):
+            return self.values[:self.filled].copy()
+        return np.concatenate([self.values[self.position:], self.values[:self.position]])
+
+def group_rows(keys: List[str]):
+    """Yield (key, row positions) per distinct key, touching Python only once per key"""
+    if len(keys) == 0:
+        return
+    unique, inverse, counts = np.unique(np.asarray(keys), return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind="stable")
+    for key, rows in zip(unique.tolist(), np.split(order, np.cumsum(counts)[:-1])):
+        yield key, rows
+
+def fit_isolation_forest(samples: np.ndarray, contamination: float) -> IsolationForest:
+    # Runs in a worker process, so it must stay a picklable module-level function
+    model = IsolationForest(n_estimators=100, contamination=contamination, random_state=42)
+    model.fit(samples)
+    return model
+
 class AnomalyDetector:
-    def __init__(self):
+    def __init__(self, window_size: int = 2000, min_samples: int = 200, refit_interval: float = 900,
+                 contamination: float = 0.01, workers: int = 1, scope: str = "type",
+                 online: Optional[OnlineStatistics] = None, ml_enabled: bool = False, score_margin: float = 0.02):
         self.models = {}
         self.thresholds = {
             'motor': {'power_kw': (0.5, 50), 'temperature_c': (20, 80), 'vibration': (0, 5)},
@@ -195,50 +2207,351 @@ class AnomalyDetector:
             'hvac': {'power_kw': (1, 75), 'temperature_c': (18, 35), 'vibration': (0, 3)},
             'conveyor': {'power_kw': (0.2, 25), 'temperature_c': (20, 60), 'vibration': (0, 4)}
         }
+        self.build_threshold_matrix()
+        
+        # Optional learned (IsolationForest) stage: sliding windows of recent readings per device
+        # type (or per device), each feeding one model
+        self.ml_enabled = ml_enabled
+        if scope not in ("type", "device"):
+            raise ValueError(f"Unknown ML model scope {scope!r}")
+        self.scope = scope
+        self.windows: Dict[str, SampleWindow] = {}
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.refit_interval = refit_interval
+        self.contamination = contamination
+        # decision_function < 0 flags `contamination` of normal readings by construction; only
+        # scores this far past the model's offset_ raise alerts
+        self.score_margin = score_margin
+        self.workers = workers
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.refit_task: Optional[asyncio.Task] = None
+        self.score_calls = 0
+        self.score_seconds = 0.0
+        self.last_score_ms = 0.0
+        self.refits = 0
+        self.refit_seconds = 0.0
+        self.last_refit_ms = 0.0
+        
+        # Optional O(1) per-reading z-score stage
+        self.online = online
     
-    async def check_thresholds(self, reading: SensorReading, device_type: str):
-        alerts = []
-        device_thresholds = self.thresholds.get(device_type, {})
+    def build_threshold_matrix(self):
+        # Rules index: one row per device type, a NaN row for unknown types, then one row per
+        # device with an override. Columns follow THRESHOLD_METRICS.
+        self.type_overrides: Dict[str, Dict[str, tuple]] = {}
+        self.device_overrides: Dict[str, Dict[str, tuple]] = {}
+        self.type_index: Dict[str, int] = {}
+        self.device_index: Dict[str, int] = {}
+        self.min_matrix = np.full((1, len(THRESHOLD_METRICS)), np.nan)
+        self.max_matrix = np.full((1, len(THRESHOLD_METRICS)), np.nan)
+        self.unknown_row = 0
+        for device_type in self.thresholds:
+            self.refresh_type_rule(device_type)
+    
+    def rule_bounds(self, device_type: Optional[str], device_id: Optional[str] = None) -> tuple:
+        mins = np.full(len(THRESHOLD_METRICS), np.nan)
+        maxs = np.full(len(THRESHOLD_METRICS), np.nan)
+        layers = [self.thresholds.get(device_type, {}), self.type_overrides.get(device_type, {})]
+        if device_id:
+            layers.append(self.device_overrides.get(device_id, {}))
+        # Later layers win; a None bound inherits from the layer below
+        for layer in layers:
+            for metric, (min_val, max_val) in layer.items():
+                column = THRESHOLD_METRICS.index(metric)
+                if min_val is not None:
+                    mins[column] = min_val
+                if max_val is not None:
+                    maxs[column] = max_val
+        return mins, maxs
+    
+    def write_rule_row(self, row: Optional[int], mins: np.ndarray, maxs: np.ndarray) -> int:
+        if row is None:
+            row = len(self.min_matrix)
+            self.min_matrix = np.vstack([self.min_matrix, mins])
+            self.max_matrix = np.vstack([self.max_matrix, maxs])
+        else:
+            self.min_matrix[row], self.max_matrix[row] = mins, maxs
+        return row
+    
+    def refresh_type_rule(self, device_type: str):
+        mins, maxs = self.rule_bounds(device_type)
+        self.type_index[device_type] = self.write_rule_row(self.type_index.get(device_type), mins, maxs)
+        # Device rows inherit from their type, so refresh the ones that depend on it
+        for device_id in self.device_overrides:
+            if device_registry.device_type(device_id) == device_type:
+                self.refresh_device_rule(device_id)
+    
+    def refresh_device_rule(self, device_id: str):
+        if device_id not in self.device_overrides:
+            row = self.device_index.pop(device_id, None)
+            if row is not None:
+                # Leave the row in place but make it inert; it is reclaimed on the next full rebuild
+                self.write_rule_row(row, np.full(len(THRESHOLD_METRICS), np.nan), np.full(len(THRESHOLD_METRICS), np.nan))
+            return
+        mins, maxs = self.rule_bounds(device_registry.device_type(device_id), device_id)
+        self.device_index[device_id] = self.write_rule_row(self.device_index.get(device_id), mins, maxs)
+    
+    def apply_threshold_override(self, config: ThresholdConfig, remove: bool = False):
+        key = config.device_id or config.device_type
+        overrides = self.device_overrides if config.device_id else self.type_overrides
+        if remove:
+            overrides.get(key, {}).pop(config.metric, None)
+            if not overrides.get(key):
+                overrides.pop(key, None)
+        else:
+            overrides.setdefault(key, {})[config.metric] = (config.min_threshold, config.max_threshold)
+        if config.device_id:
+            self.refresh_device_rule(config.device_id)
+        else:
+            self.refresh_type_rule(config.device_type)
+    
+    async def load_threshold_overrides(self):
+        self.build_threshold_matrix()
+        overrides = await db.threshold_overrides.find({}, {"_id": 0}).to_list(None)
+        for override in overrides:
+            self.apply_threshold_override(ThresholdConfig(**override))
+    
+    def evaluate_thresholds(self, device_ids: List[str], device_types: List[str], values: np.ndarray) -> List[Alert]:
+        """Check N readings at once; `values` is an N x len(THRESHOLD_METRICS) array"""
+        if len(device_ids) == 0:
+            return []
+        device_index = self.device_index
+        type_index = self.type_index
+        unknown_row = self.unknown_row
+        rows = np.fromiter(
+            (device_index[device_id] if device_id in device_index else type_index.get(device_type, unknown_row)
+             for device_id, device_type in zip(device_ids, device_types)),
+            dtype=np.intp, count=len(device_types)
+        )
+        mins = self.min_matrix[rows]
+        maxs = self.max_matrix[rows]
         
-        for metric, (min_val, max_val) in device_thresholds.items():
-            value = getattr(reading, metric)
-            severity = "low"
-            
-            if value < min_val or value > max_val:
-                # Determine severity based on how far from threshold
-                if value < min_val:
-                    deviation = (min_val - value) / min_val
-                else:
-                    deviation = (value - max_val) / max_val
-                
-                if deviation > 0.5:
-                    severity = "critical"
-                elif deviation > 0.3:
-                    severity = "high"
-                elif deviation > 0.1:
-                    severity = "medium"
-                
-                threshold = max_val if value > max_val else min_val
-                alert = Alert(
-                    device_id=reading.device_id,
-                    alert_type="threshold_exceeded",
+        below = values < mins
+        above = values > maxs
+        violations = below | above
+        if not violations.any():
+            return []
+        
+        # Severity based on how far from threshold; a zero threshold makes any breach critical
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deviation = np.where(below, (mins - values) / mins, (values - maxs) / maxs)
+        deviation = np.nan_to_num(deviation, nan=np.inf)
+        severity_index = np.digitize(deviation, [0.1, 0.3, 0.5], right=True)
+        thresholds = np.where(above, maxs, mins)
+        
+        alerts = []
+        for row, column in zip(*np.nonzero(violations)):
+            metric = THRESHOLD_METRICS[column]
+            value = float(values[row, column])
+            threshold = float(thresholds[row, column])
+            alerts.append(Alert(
+                device_id=device_ids[row],
+                alert_type="threshold_exceeded",
+                metric=metric,
+                value=value,
+                threshold=threshold,
+                severity=SEVERITY_LEVELS[severity_index[row, column]],
+                message=f"{metric} {value:.2f} exceeded threshold {threshold:.2f}"
+            ))
+        return alerts
+    
+    @staticmethod
+    def readings_matrix(readings: List[SensorReading]) -> np.ndarray:
+        return np.array([[getattr(reading, metric) for metric in THRESHOLD_METRICS] for reading in readings],
+                        dtype=np.float64).reshape(len(readings), len(THRESHOLD_METRICS))
+    
+    def model_keys(self, device_ids: List[str], device_types: List[str]) -> List[str]:
+        return device_types if self.scope == "type" else device_ids
+    
+    def observe(self, keys: List[str], values: np.ndarray):
+        for key, rows in group_rows(keys):
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = SampleWindow(self.window_size, values.shape[1])
+            window.extend(values[rows])
+    
+    def score(self, models: dict, keys: List[str], device_ids: List[str], values: np.ndarray) -> List[Alert]:
+        """Score a micro-batch against the cached models, one decision_function call per model.
+
+        Runs in a worker thread: `models` is a snapshot that refits replace rather than mutate.
+        """
+        started = time.perf_counter()
+        alerts = []
+        for key, rows in group_rows(keys):
+            entry = models.get(key)
+            if entry is None:
+                continue
+            batch = values[rows]
+            scores = entry["model"].decision_function(batch)
+            for offset in np.nonzero(scores < -self.score_margin)[0]:
+                sample = batch[offset]
+                # Attribute the anomaly to the metric furthest from its learned mean
+                z_scores = np.abs(sample - entry["mean"]) / entry["std"]
+                column = int(np.argmax(z_scores))
+                metric = THRESHOLD_METRICS[column]
+                value = float(sample[column])
+                threshold = float(entry["max"][column] if value > entry["mean"][column] else entry["min"][column])
+                score = float(scores[offset])
+                alerts.append(Alert(
+                    device_id=device_ids[rows[offset]],
+                    alert_type="anomaly_detected",
                     metric=metric,
                     value=value,
                     threshold=threshold,
-                    severity=severity,
-                    message=f"{metric} {value:.2f} exceeded threshold {threshold:.2f}"
-                )
-                alerts.append(alert)
+                    severity=SEVERITY_LEVELS[int(np.digitize(-score, [0.05, 0.1, 0.15]))],
+                    message=f"{metric} {value:.2f} is anomalous for this {self.scope} (model v{entry['version']}, score {score:.3f})"
+                ))
         
+        elapsed = time.perf_counter() - started
+        self.score_calls += 1
+        self.score_seconds += elapsed
+        self.last_score_ms = elapsed * 1000
         return alerts
+    
+    async def analyze_readings(self, readings: List[SensorReading], device_types: List[str]) -> List[Alert]:
+        """Run every detection stage over a batch of readings"""
+        return await self.analyze_matrix([reading.device_id for reading in readings], device_types,
+                                         self.readings_matrix(readings))
+    
+    async def analyze_matrix(self, device_ids: List[str], device_types: List[str], values: np.ndarray) -> List[Alert]:
+        """Run every detection stage over an N x len(THRESHOLD_METRICS) array of readings"""
+        alerts = self.evaluate_thresholds(device_ids, device_types, values)
+        if self.ml_enabled:
+            keys = self.model_keys(device_ids, device_types)
+            if self.models and len(device_ids):
+                # Tree traversal releases the GIL, so model scoring stays off the event loop
+                loop = asyncio.get_running_loop()
+                alerts.extend(await loop.run_in_executor(None, self.score, self.models, keys, device_ids, values))
+            self.observe(keys, values)
+        if self.online:
+            alerts.extend(self.online.score(device_ids, values))
+        return alerts
+    
+    async def refit_models(self):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        for key, window in list(self.windows.items()):
+            entry = self.models.get(key)
+            if len(window) < self.min_samples or (entry and now - entry["trained_at"] < self.refit_interval):
+                continue
+            samples = window.samples()
+            started = time.perf_counter()
+            model = await loop.run_in_executor(self.pool, fit_isolation_forest, samples, self.contamination)
+            elapsed = time.perf_counter() - started
+            std = samples.std(axis=0)
+            # Swap in a new dict so a scoring thread holding the old one never sees it change
+            self.models = {**self.models, key: {
+                "model": model,
+                "version": entry["version"] + 1 if entry else 1,
+                "trained_at": time.time(),
+                "samples": len(samples),
+                "mean": samples.mean(axis=0),
+                "std": np.where(std > 0, std, 1.0),
+                "min": samples.min(axis=0),
+                "max": samples.max(axis=0),
+            }}
+            self.refits += 1
+            self.refit_seconds += elapsed
+            self.last_refit_ms = elapsed * 1000
+    
+    async def run_refits(self):
+        while True:
+            try:
+                await self.refit_models()
+            except Exception as e:
+                logging.error(f"Model refit error: {e}")
+            await asyncio.sleep(min(self.refit_interval, 60))
+    
+    def start(self):
+        if self.ml_enabled and self.refit_task is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.refit_task = asyncio.create_task(self.run_refits())
+        if self.online:
+            self.online.start()
+    
+    async def stop(self):
+        if self.refit_task:
+            self.refit_task.cancel()
+            try:
+                await self.refit_task
+            except asyncio.CancelledError:
+                pass
+            self.refit_task = None
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.online:
+            await self.online.stop()
+    
+    def stats(self) -> dict:
+        return {
+            "ml_enabled": self.ml_enabled,
+            "scope": self.scope,
+            "score_margin": self.score_margin,
+            "models": len(self.models),
+            "windows": len(self.windows),
+            "score_calls": self.score_calls,
+            "avg_score_ms": round(self.score_seconds / self.score_calls * 1000, 3) if self.score_calls else 0.0,
+            "last_score_ms": round(self.last_score_ms, 3),
+            "refits": self.refits,
+            "avg_refit_ms": round(self.refit_seconds / self.refits * 1000, 1) if self.refits else 0.0,
+            "last_refit_ms": round(self.last_refit_ms, 1),
+            "online": self.online.stats() if self.online else None
+        }
 
-anomaly_detector = AnomalyDetector()
+anomaly_detector = AnomalyDetector(
+    window_size=int(os.environ.get('ML_WINDOW_SIZE', 2000)),
+    min_samples=int(os.environ.get('ML_MIN_SAMPLES', 200)),
+    refit_interval=float(os.environ.get('ML_REFIT_INTERVAL_SECONDS', 900)),
+    contamination=float(os.environ.get('ML_CONTAMINATION', 0.01)),
+    workers=int(os.environ.get('ML_WORKERS', 1)),
+    scope=os.environ.get('ML_MODEL_SCOPE', 'type'),
+    ml_enabled=os.environ.get('ML_ENABLED', 'false').lower() == 'true',
+    score_margin=float(os.environ.get('ML_SCORE_MARGIN', 0.02)),
+    online=OnlineStatistics(
+        z_limit=float(os.environ.get('ONLINE_ZSCORE_LIMIT', 4.0)),
+        warmup=int(os.environ.get('ONLINE_WARMUP_READINGS', 30)),
+        alpha=float(os.environ.get('ONLINE_EWMA_ALPHA', 0.05)),
+        basis=os.environ.get('ONLINE_ZSCORE_BASIS', 'welford'),
+        snapshot_interval=float(os.environ.get('ONLINE_SNAPSHOT_SECONDS', 60))
+    ) if os.environ.get('ONLINE_STATS_ENABLED', 'false').lower() == 'true' else None
+)
 
 # Industrial Equipment Simulator
+# Per-type baseline for each of SENSOR_METRICS
+SIMULATOR_BASE_VALUES = {
+    'motor': [25, 65, 2.5, 8],
+    'compressor': [45, 75, 4, 12],
+    'hvac': [35, 22, 1.5, 16],
+    'conveyor': [12, 45, 2, 10]
+}
+
+# Uniform factor ranges applied to the baseline, per metric
+SIMULATOR_NORMAL_FACTORS = np.array([[0.8, 1.2], [0.9, 1.1], [0.7, 1.3], [0.95, 1.05]])
+SIMULATOR_ANOMALY_FACTORS = np.array([[1.5, 3.0], [1.2, 1.8], [2.0, 4.0], [0.95, 1.05]])
+SIMULATOR_DECIMALS = np.array([2, 1, 2, 1])
+
 class EquipmentSimulator:
-    def __init__(self):
+    def __init__(self, device_count: int = 0, tick_seconds: float = 5, anomaly_rate: float = 0.05,
+                 seed: Optional[int] = None):
         self.devices = []
         self.running = False
+        self.configure(device_count, tick_seconds, anomaly_rate, seed)
+    
+    def configure(self, device_count: int, tick_seconds: float, anomaly_rate: float, seed: Optional[int]):
+        # device_count 0 simulates the default devices plus every registered one
+        self.device_count = device_count
+        self.tick_seconds = tick_seconds
+        self.anomaly_rate = anomaly_rate
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.ticks = 0
+        self.readings = 0
+        self.overruns = 0
+        self.last_tick_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
         
     async def initialize_devices(self):
         # Create default industrial devices if they don't exist
@@ -251,89 +2564,345 @@ class EquipmentSimulator:
             {"name": "Conveyor-CV1", "type": "conveyor", "location": "Packaging Area"},
             {"name": "Conveyor-CV2", "type": "conveyor", "location": "Shipping Area"},
         ]
+        # Larger plants are padded with virtual devices spread over the device types. They are
+        # kept (and reused by later runs) but never listed, counted or simulated by default.
+        device_types = list(SIMULATOR_BASE_VALUES)
+        for index in range(len(device_configs), self.device_count):
+            device_type = device_types[index % len(device_types)]
+            device_configs.append({
+                "name": f"Sim-{device_type}-{index:05d}",
+                "type": device_type,
+                "location": f"Virtual Zone {index % 50 + 1}",
+                "virtual": True
+            })
         
-        for config in device_configs:
-            existing = await db.devices.find_one({"name": config["name"]})
-            if not existing:
-                device = Device(**config)
-                await db.devices.insert_one(device.dict())
-                self.devices.append(device)
-        
-        # Load existing devices
-        devices = await db.devices.find().to_list(1000)
-        self.devices = [Device(**device) for device in devices]
-    
-    def generate_reading(self, device: Device):
-        base_values = {
-            'motor': {'power_kw': 25, 'temperature_c': 65, 'vibration': 2.5, 'runtime_hours': 8},
-            'compressor': {'power_kw': 45, 'temperature_c': 75, 'vibration': 4, 'runtime_hours': 12},
-            'hvac': {'power_kw': 35, 'temperature_c': 22, 'vibration': 1.5, 'runtime_hours': 16},
-            'conveyor': {'power_kw': 12, 'temperature_c': 45, 'vibration': 2, 'runtime_hours': 10}
-        }
-        
-        base = base_values.get(device.type, base_values['motor'])
-        
-        # Add realistic variations and occasional anomalies
-        anomaly_chance = 0.05  # 5% chance of anomaly
+        missing = [Device(**config) for config in device_configs if not device_registry.get_by_name(config["name"])]
+        if missing:
+            await db.devices.insert_many([device.dict() for device in missing])
+            for device in missing:
+                device_registry.add(device)
         
-        if random.random() < anomaly_chance:
-            # Generate anomaly
-            anomaly_factor = random.uniform(1.5, 3.0)
-            power_kw = base['power_kw'] * anomaly_factor
-            temperature_c = base['temperature_c'] * random.uniform(1.2, 1.8)
-            vibration = base['vibration'] * random.uniform(2.0, 4.0)
+        if self.device_count:
+            self.devices = [device_registry.get_by_name(config["name"]) for config in device_configs[:self.device_count]]
         else:
-            # Normal operation with small variations
-            power_kw = base['power_kw'] * random.uniform(0.8, 1.2)
-            temperature_c = base['temperature_c'] * random.uniform(0.9, 1.1)
-            vibration = base['vibration'] * random.uniform(0.7, 1.3)
-        
-        runtime_hours = base['runtime_hours'] * random.uniform(0.95, 1.05)
-        
-        return SensorReading(
-            device_id=device.id,
-            power_kw=round(power_kw, 2),
-            temperature_c=round(temperature_c, 1),
-            vibration=round(vibration, 2),
-            runtime_hours=round(runtime_hours, 1)
+            self.devices = device_registry.all()
+        self.device_ids = [device.id for device in self.devices]
+        self.device_types = [device.type for device in self.devices]
+        self.base_values = np.array([SIMULATOR_BASE_VALUES.get(device.type, SIMULATOR_BASE_VALUES['motor'])
+                                     for device in self.devices], dtype=np.float64).reshape(len(self.devices), len(SENSOR_METRICS))
+    
+    @staticmethod
+    async def mark_virtual_devices():
+        """Flag padding devices created before devices carried `virtual`"""
+        result = await db.devices.update_many(
+            {
+                "name": {"$regex": f"^Sim-({'|'.join(SIMULATOR_BASE_VALUES)})-\\d{{5,}}$"},
+                "location": {"$regex": "^Virtual Zone \\d+$"},
+                "virtual": {"$ne": True}
+            },
+            {"$set": {"virtual": True}}
         )
+        if result.modified_count:
+            logging.info(f"Marked {result.modified_count} simulator padding devices as virtual")
+    
+    def generate_tick(self) -> np.ndarray:
+        """Readings for every device in one shot, as an N x len(SENSOR_METRICS) array"""
+        count = len(self.devices)
+        anomalies = self.rng.random(count) < self.anomaly_rate
+        low = np.where(anomalies[:, None], SIMULATOR_ANOMALY_FACTORS[:, 0], SIMULATOR_NORMAL_FACTORS[:, 0])
+        high = np.where(anomalies[:, None], SIMULATOR_ANOMALY_FACTORS[:, 1], SIMULATOR_NORMAL_FACTORS[:, 1])
+        values = self.base_values * self.rng.uniform(low, high)
+        for column, decimals in enumerate(SIMULATOR_DECIMALS):
+            values[:, column] = values[:, column].round(decimals)
+        return values
     
     async def simulate_data(self):
+        threshold_columns = [SENSOR_METRICS.index(metric) for metric in THRESHOLD_METRICS]
+        self.started_at = time.perf_counter()
         while self.running:
+            tick_started = time.perf_counter()
             try:
-                for device in self.devices:
-                    reading = self.generate_reading(device)
-                    
-                    # Store reading
-                    await db.sensor_readings.insert_one(reading.dict())
-                    
-                    # Check for anomalies
-                    alerts = await anomaly_detector.check_thresholds(reading, device.type)
-                    
-                    # Store alerts
-                    for alert in alerts:
-                        await db.alerts.insert_one(alert.dict())
-                    
-                    # Broadcast real-time data
+                values = self.generate_tick()
+                timestamp = datetime.now(timezone.utc)
+                readings = [
+                    {"id": str(uuid.uuid4()), "device_id": device_id, "timestamp": timestamp, **dict(zip(SENSOR_METRICS, row))}
+                    for device_id, row in zip(self.device_ids, values.tolist())
+                ]
+                
+                # Queue readings for storage; a full buffer holds the tick back
+                sequence = await write_buffer.put_many("sensor_readings", [dict(reading) for reading in readings])
+                dashboard_summary.observe_readings(values[:, SENSOR_METRICS.index("power_kw")].tolist(), sequence, timestamp)
+                latest_readings.update(readings)
+                
+                # Run anomaly detection over the whole tick at once
+                alerts = await anomaly_detector.analyze_matrix(self.device_ids, self.device_types, values[:, threshold_columns])
+                
+                # Coalesce repeats of open alerts and queue the rest for storage
+                alerts = await alert_coalescer.record(alerts)
+                
+                # Broadcast real-time data to subscribers; other workers get the whole tick as one bus event
+                device_names = [device.name for device in self.devices]
+                manager.deliver_readings(readings, device_names)
+                broadcast_bus.publish({"kind": "readings", "readings": readings, "device_names": device_names})
+                
+                alert_groups: Dict[tuple, List[Alert]] = {}
+                for alert in alerts:
+                    alert_groups.setdefault((alert.device_id, alert.severity), []).append(alert)
+                for (device_id, severity), group in alert_groups.items():
                     await manager.broadcast({
-                        "type": "sensor_reading",
-                        "data": reading.dict(),
-                        "device_name": device.name
-                    })
-                    
-                    if alerts:
-                        await manager.broadcast({
-                            "type": "alert",
-                            "data": [alert.dict() for alert in alerts]
-                        })
+                        "type": "alert",
+                        "data": [alert.dict() for alert in group]
+                    }, device_id=device_id, severity=severity)
                 
-                await asyncio.sleep(5)  # Generate data every 5 seconds
+                self.ticks += 1
+                self.readings += len(readings)
+                # Hold the tick rate: sleep only for what is left of the interval
+                self.last_tick_seconds = time.perf_counter() - tick_started
+                if self.last_tick_seconds > self.tick_seconds:
+                    self.overruns += 1
+                await asyncio.sleep(max(self.tick_seconds - self.last_tick_seconds, 0))
                 
             except Exception as e:
                 logging.error(f"Simulation error: {e}")
                 await asyncio.sleep(1)
+        self.stopped_at = time.perf_counter()
+    
+    def stats(self) -> dict:
+        elapsed = (self.stopped_at or time.perf_counter()) - self.started_at if self.started_at else 0.0
+        return {
+            "running": self.running,
+            "devices": len(self.devices),
+            "tick_seconds": self.tick_seconds,
+            "anomaly_rate": self.anomaly_rate,
+            "seed": self.seed,
+            "ticks": self.ticks,
+            "readings": self.readings,
+            "target_readings_per_second": round(len(self.devices) / self.tick_seconds, 2) if self.tick_seconds else None,
+            "achieved_readings_per_second": round(self.readings / elapsed, 2) if elapsed else 0.0,
+            "last_tick_seconds": round(self.last_tick_seconds, 4),
+            "overruns": self.overruns
+        }
 
-simulator = EquipmentSimulator()
+simulator = EquipmentSimulator(
+    device_count=int(os.environ.get('SIMULATOR_DEVICES', 0)),
+    tick_seconds=float(os.environ.get('SIMULATOR_TICK_SECONDS', 5)),
+    anomaly_rate=float(os.environ.get('SIMULATOR_ANOMALY_RATE', 0.05)),
+    seed=int(os.environ['SIMULATOR_SEED']) if os.environ.get('SIMULATOR_SEED') else None
+)
+
+def build_readings_query(device_id: Optional[str] = None, from_time: Optional[datetime] = None,
+                         to_time: Optional[datetime] = None) -> dict:
+    query = {}
+    if device_id:
+        query["device_id"] = device_id
+    if from_time:
+        query["timestamp"] = {"$gte": from_time}
+    if to_time:
+        query.setdefault("timestamp", {})["$lte"] = to_time
+    return query
+
+# Keyset pagination over (timestamp, id), newest first
+def encode_cursor(document: dict) -> str:
+    raw = f"{as_utc(document['timestamp']).isoformat()}|{document['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def keyset_after(query: dict, timestamp: datetime, document_id: str, direction: int = -1) -> dict:
+    """Narrow `query` to documents strictly after (timestamp, id) in the given sort direction"""
+    operator = "$lt" if direction < 0 else "$gt"
+    after = {"$or": [
+        {"timestamp": {operator: timestamp}},
+        {"timestamp": timestamp, "id": {operator: document_id}}
+    ]}
+    return {"$and": [query, after]} if query else after
+
+def keyset_query(query: dict, cursor: Optional[str], direction: int = -1) -> dict:
+    """Narrow `query` to documents strictly after an opaque `cursor` from encode_cursor"""
+    if not cursor:
+        return query
+    try:
+        timestamp, document_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        timestamp = datetime.fromisoformat(timestamp)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return keyset_after(query, timestamp, document_id, direction)
+
+KEYSET_SORT = [("timestamp", -1), ("id", -1)]
+KEYSET_SORT_ASCENDING = [("timestamp", 1), ("id", 1)]
+
+# Streaming export
+EXPORT_FIELDS = ["id", "device_id", "timestamp", *SENSOR_METRICS]
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+async def stream_readings(query: dict, export_format: str, batch_size: int):
+    projection = {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}}
+    cursor = db.sensor_readings.find(query, projection).sort(KEYSET_SORT_ASCENDING).batch_size(batch_size)
+    if export_format == "csv":
+        yield ",".join(EXPORT_FIELDS) + "\n"
+    # Emit one chunk per cursor batch so memory stays flat regardless of export size
+    lines = []
+    async for reading in cursor:
+        reading["timestamp"] = as_utc(reading["timestamp"]).isoformat()
+        if export_format == "csv":
+            lines.append(",".join(str(reading.get(field, "")) for field in EXPORT_FIELDS) + "\n")
+        else:
+            lines.append(json.dumps(reading) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+READINGS_ARROW_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("device_id", pa.dictionary(pa.int32(), pa.string())),
+        ("timestamp", pa.timestamp("ms", tz="UTC")),
+    ]
+    + [(metric, pa.float64()) for metric in SENSOR_METRICS]
+)
+
+def readings_record_batch(columns: Dict[str, list]) -> pa.RecordBatch:
+    arrays = [
+        pa.array(columns["id"], type=pa.string()),
+        pa.array(columns["device_id"], type=pa.string()).dictionary_encode(),
+        pa.array(columns["timestamp"], type=pa.timestamp("ms", tz="UTC")),
+    ] + [pa.array(columns[metric], type=pa.float64()) for metric in SENSOR_METRICS]
+    return pa.RecordBatch.from_arrays(arrays, schema=READINGS_ARROW_SCHEMA)
+
+async def stream_readings_columnar(query: dict, export_format: str, batch_size: int):
+    # Cursor batches go straight into columnar arrays, no per-row models
+    projection = {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}}
+    cursor = db.sensor_readings.find(query, projection).sort(KEYSET_SORT_ASCENDING).batch_size(batch_size)
+    sink = io.BytesIO()
+    if export_format == "parquet":
+        writer = pq.ParquetWriter(sink, READINGS_ARROW_SCHEMA, compression="zstd")
+        write = writer.write_batch
+    else:
+        writer = pa.ipc.new_stream(sink, READINGS_ARROW_SCHEMA)
+        write = writer.write_batch
+    
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+    
+    columns = {field: [] for field in EXPORT_FIELDS}
+    rows = 0
+    async for reading in cursor:
+        for field in EXPORT_FIELDS:
+            columns[field].append(reading.get(field))
+        rows += 1
+        if rows >= batch_size:
+            write(readings_record_batch(columns))
+            columns = {field: [] for field in EXPORT_FIELDS}
+            rows = 0
+            yield drain()
+    if rows:
+        write(readings_record_batch(columns))
+    writer.close()
+    yield drain()
+
+# Time-series downsampling
+BUCKET_UNITS = {'s': 's', 'm': 'min', 'h': 'h', 'd': 'D'}
+BUCKET_AGGREGATES = ('min', 'max', 'avg', 'p95')
+
+def parse_bucket(bucket: str) -> str:
+    # "15m" -> pandas frequency "15min"
+    match = re.fullmatch(r"(\d+)([smhd])", bucket)
+    if not match or int(match.group(1)) == 0:
+        raise HTTPException(status_code=400, detail="bucket must look like 30s, 1m, 15m, 1h or 1d")
+    return f"{match.group(1)}{BUCKET_UNITS[match.group(2)]}"
+
+def parse_aggregates(agg: str) -> List[str]:
+    aggregates = [name.strip() for name in agg.split(',') if name.strip()]
+    invalid = [name for name in aggregates if name not in BUCKET_AGGREGATES]
+    if invalid or not aggregates:
+        raise HTTPException(status_code=400, detail=f"agg must be a comma-separated subset of {', '.join(BUCKET_AGGREGATES)}")
+    return aggregates
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    if fields is None:
+        return list(SENSOR_METRICS)
+    selected = [name.strip() for name in fields.split(',') if name.strip()]
+    invalid = [name for name in selected if name not in SENSOR_METRICS]
+    if invalid or not selected:
+        raise HTTPException(status_code=400, detail=f"fields must be a comma-separated subset of {', '.join(SENSOR_METRICS)}")
+    return selected
+
+def readings_page(readings: List[dict], include_id: bool) -> bytes:
+    """Serialize projected reading dicts straight to JSON, skipping per-row model validation"""
+    for reading in readings:
+        reading["timestamp"] = as_utc(reading["timestamp"]).isoformat()
+        if not include_id:
+            del reading["id"]
+    return json.dumps(readings).encode()
+
+def isoformat_utc(timestamps: pd.Series) -> pd.Series:
+    # Same form as readings_page: Mongo's naive datetimes are UTC
+    return pd.to_datetime(timestamps, utc=True).map(lambda timestamp: timestamp.isoformat())
+
+async def load_readings_frame(query: dict, metrics: List[str]) -> pd.DataFrame:
+    projection = {"_id": 0, "device_id": 1, "timestamp": 1, **{metric: 1 for metric in metrics}}
+    readings = await db.sensor_readings.find(query, projection).sort("timestamp", 1).to_list(None)
+    return pd.DataFrame(readings, columns=["device_id", "timestamp", *metrics])
+
+def aggregate_buckets(frame: pd.DataFrame, frequency: str, aggregates: List[str], metrics: List[str]) -> List[dict]:
+    points = []
+    for device_id, group in frame.groupby("device_id", sort=False):
+        resampled = group.set_index("timestamp")[metrics].resample(frequency)
+        columns = {"count": resampled[metrics[0]].count()}
+        for aggregate in aggregates:
+            if aggregate == "p95":
+                values = resampled.quantile(0.95)
+            elif aggregate == "avg":
+                values = resampled.mean()
+            else:
+                values = getattr(resampled, aggregate)()
+            for metric in metrics:
+                columns[f"{metric}_{aggregate}"] = values[metric].round(3)
+        table = pd.DataFrame(columns)
+        table = table[table["count"] > 0].reset_index()
+        table["timestamp"] = isoformat_utc(table["timestamp"])
+        table.insert(0, "device_id", device_id)
+        points.extend(table.to_dict("records"))
+    return points
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-triangle-three-buckets: pick `threshold` points that preserve the visual shape"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    indices[-1] = n - 1
+    return indices
+
+def lttb_downsample(frame: pd.DataFrame, max_points: int, metric: str) -> List[dict]:
+    points = []
+    for device_id, group in frame.groupby("device_id", sort=False):
+        x = group["timestamp"].astype("int64").to_numpy(dtype=np.float64)
+        y = group[metric].to_numpy(dtype=np.float64)
+        sampled = group.iloc[lttb_indices(x, y, max_points)].copy()
+        sampled["timestamp"] = isoformat_utc(sampled["timestamp"])
+        points.extend(sampled.to_dict("records"))
+    return points
 
 # API Routes
 @api_router.post("/auth/register", response_model=User)
@@ -375,102 +2944,324 @@ async def login(user_data: UserLogin):
         username=user['username']
     )
 
+@api_router.put("/users/{username}/role", response_model=User)
+async def update_user_role(username: str, role_update: UserRoleUpdate, current_user: User = Depends(require_role(["admin"]))):
+    if role_update.role not in ("engineer", "manager", "admin"):
+        raise HTTPException(status_code=400, detail="Invalid role")
+    user = await db.users.find_one_and_update(
+        {"username": username},
+        {"$set": {"role": role_update.role}},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    # Cached principals still carry the old role
+    principal_cache.invalidate_user(username)
+    broadcast_bus.publish({"kind": "invalidate_user", "username": username})
+    return User(**user)
+
+@api_router.get("/system/stats")
+async def get_system_stats(current_user: User = Depends(require_role(["admin"]))):
+    return {
+        "principal_cache": principal_cache.stats(),
+        "write_buffer": write_buffer.stats(),
+        "rollups": reading_rollups.stats(),
+        "anomaly_detector": anomaly_detector.stats(),
+        "alert_coalescer": alert_coalescer.stats(),
+        "websocket": manager.stats(),
+        "broadcast_bus": broadcast_bus.stats(),
+        "simulator": simulator.stats(),
+        "retention": retention_manager.stats(),
+        "dashboard_summary": dashboard_summary.stats(),
+        "latest_readings": latest_readings.stats()
+    }
+
+@api_router.get("/system/storage")
+async def get_storage_report(current_user: User = Depends(require_role(["admin"]))):
+    return await retention_manager.storage_report()
+
 @api_router.get("/devices", response_model=List[Device])
 async def get_devices(current_user: User = Depends(get_current_user)):
-    devices = await db.devices.find().to_list(1000)
-    return [Device(**device) for device in devices]
+    return device_registry.all()
+
+@api_router.get("/devices/state")
+async def get_device_state(current_user: User = Depends(get_current_user)):
+    # Latest reading of every device from the last-value cache, no reading scan
+    return latest_readings.snapshot()
 
 @api_router.post("/devices", response_model=Device)
 async def create_device(device_data: DeviceCreate, current_user: User = Depends(require_role(["admin", "manager"]))):
     device = Device(**device_data.dict())
     await db.devices.insert_one(device.dict())
+    device_registry.add(device)
+    broadcast_bus.publish({"kind": "device", "device": device.dict()})
     return device
 
 @api_router.post("/sensor-ingest")
 async def ingest_sensor_data(readings: List[SensorIngest], current_user: User = Depends(get_current_user)):
-    for reading_data in readings:
-        reading = SensorReading(**reading_data.dict())
-        await db.sensor_readings.insert_one(reading.dict())
-        
-        # Get device type for anomaly detection
-        device = await db.devices.find_one({"id": reading.device_id})
-        if device:
-            alerts = await anomaly_detector.check_thresholds(reading, device['type'])
-            for alert in alerts:
-                await db.alerts.insert_one(alert.dict())
+    rejected = []
+    accepted = []
+    device_types = []
+    for index, reading_data in enumerate(readings):
+        device_type = device_registry.device_type(reading_data.device_id)
+        if device_type is None:
+            rejected.append({"index": index, "device_id": reading_data.device_id, "reason": "Unknown device"})
+            continue
+        accepted.append(SensorReading(**reading_data.dict()))
+        device_types.append(device_type)
+    
+    # Run anomaly detection over the whole batch at once
+    alerts = await anomaly_detector.analyze_readings(accepted, device_types)
     
-    return {"message": f"Ingested {len(readings)} sensor readings"}
+    # Hand the batch to the write-behind buffer; it is flushed with unordered bulk inserts
+    sequence = await write_buffer.put_many("sensor_readings", [reading.dict() for reading in accepted])
+    dashboard_summary.observe_readings([reading.power_kw for reading in accepted], sequence)
+    latest = [reading.dict() for reading in accepted]
+    latest_readings.update(latest)
+    if latest:
+        broadcast_bus.publish({"kind": "readings", "readings": latest})
+    new_alerts = await alert_coalescer.record(alerts)
+    
+    return {
+        "message": f"Ingested {len(accepted)} sensor readings",
+        "accepted": len(accepted),
+        "rejected": len(rejected),
+        "alerts_created": len(new_alerts),
+        "alerts_coalesced": len(alerts) - len(new_alerts),
+        "errors": rejected
+    }
 
 @api_router.get("/metrics")
 async def get_metrics(
     device_id: Optional[str] = None,
     from_time: Optional[datetime] = None,
     to_time: Optional[datetime] = None,
+    bucket: Optional[str] = None,
+    agg: str = "avg",
+    lttb_points: Optional[int] = None,
+    lttb_metric: str = "power_kw",
+    fields: Optional[str] = None,
+    limit: int = 1000,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    query = {}
-    if device_id:
-        query["device_id"] = device_id
-    if from_time:
-        query["timestamp"] = {"$gte": from_time}
-    if to_time:
-        query.setdefault("timestamp", {})["$lte"] = to_time
+    metrics = parse_fields(fields)
+    downsampled = bucket is not None or lttb_points is not None
+    if downsampled and from_time is None:
+        # Downsampled views default to the last 24 hours so their cost stays bounded
+        from_time = (to_time or datetime.now(timezone.utc)) - timedelta(hours=24)
+    
+    query = build_readings_query(device_id, from_time, to_time)
+    
+    if bucket is not None:
+        frequency = parse_bucket(bucket)
+        aggregates = parse_aggregates(agg)
+        resolution = ReadingRollups.resolution_for(frequency)
+        if resolution and "p95" not in aggregates:
+            # Served from pre-aggregated rollups in O(buckets) instead of O(raw readings)
+            frame = await reading_rollups.load_frame(resolution, device_id, from_time, to_time, metrics)
+            return ReadingRollups.aggregate(frame, frequency, aggregates, metrics)
+        frame = await load_readings_frame(query, metrics)
+        return aggregate_buckets(frame, frequency, aggregates, metrics)
     
-    readings = await db.sensor_readings.find(query).sort("timestamp", -1).limit(1000).to_list(1000)
-    return [SensorReading(**reading) for reading in readings]
+    if lttb_points is not None:
+        if lttb_points < 3:
+            raise HTTPException(status_code=400, detail="lttb_points must be at least 3")
+        if lttb_metric not in SENSOR_METRICS:
+            raise HTTPException(status_code=400, detail=f"lttb_metric must be one of {', '.join(SENSOR_METRICS)}")
+        frame = await load_readings_frame(query, list(dict.fromkeys([lttb_metric, *metrics])))
+        return lttb_downsample(frame, lttb_points, lttb_metric)
+    
+    if not 1 <= limit <= 10000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 10000")
+    # id is always fetched for the cursor, but only returned when every field is
+    projection = {"_id": 0, "id": 1, "device_id": 1, "timestamp": 1, **{metric: 1 for metric in metrics}}
+    readings = await db.sensor_readings.find(keyset_query(query, cursor), projection).sort(KEYSET_SORT).limit(limit).to_list(limit)
+    headers = {}
+    if len(readings) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(readings[-1])
+    return Response(content=readings_page(readings, fields is None), media_type="application/json", headers=headers)
+
+@api_router.get("/metrics/export")
+async def export_metrics(
+    device_id: Optional[str] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+    after_id: Optional[str] = None,
+    format: str = "ndjson",
+    batch_size: int = 2000,
+    current_user: User = Depends(get_current_user)
+):
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_MEDIA_TYPES)}")
+    if not 1 <= batch_size <= 10000:
+        raise HTTPException(status_code=400, detail="batch_size must be between 1 and 10000")
+    
+    query = build_readings_query(device_id, from_time, to_time)
+    if after and after_id:
+        # Resume after the last row a previous export delivered; readings often share a timestamp
+        query = keyset_after(query, after, after_id, direction=1)
+    elif after:
+        query.setdefault("timestamp", {})["$gt"] = after
+    
+    if format in ("arrow", "parquet"):
+        body = stream_readings_columnar(query, format, batch_size)
+    else:
+        body = stream_readings(query, format, batch_size)
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="sensor_readings.{format}"'}
+    )
+
+def build_alerts_query(device_id: Optional[str] = None, metric: Optional[str] = None, severity: Optional[str] = None,
+                       from_time: Optional[datetime] = None, to_time: Optional[datetime] = None) -> dict:
+    query = build_readings_query(device_id, from_time, to_time)
+    if metric:
+        query["metric"] = metric
+    if severity:
+        query["severity"] = severity
+    return query
 
 @api_router.get("/alerts", response_model=List[Alert])
 async def get_alerts(
+    response: Response,
     device_id: Optional[str] = None,
     acknowledged: Optional[bool] = None,
+    metric: Optional[str] = None,
+    severity: Optional[str] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    query = {}
-    if device_id:
-        query["device_id"] = device_id
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    query = build_alerts_query(device_id, metric, severity, from_time, to_time)
     if acknowledged is not None:
         query["acknowledged"] = acknowledged
     
-    alerts = await db.alerts.find(query).sort("timestamp", -1).limit(100).to_list(100)
+    alerts = await db.alerts.find(keyset_query(query, cursor)).sort(KEYSET_SORT).limit(limit).to_list(limit)
+    if len(alerts) == limit:
+        # A full page may have more behind it
+        response.headers["X-Next-Cursor"] = encode_cursor(alerts[-1])
     return [Alert(**alert) for alert in alerts]
 
 @api_router.post("/alerts/acknowledge")
 async def acknowledge_alert(alert_ack: AlertAck, current_user: User = Depends(get_current_user)):
     result = await db.alerts.update_one(
-        {"id": alert_ack.alert_id},
-        {"$set": {"acknowledged": True}}
+        {"id": alert_ack.alert_id, "acknowledged": False},
+        {"$set": {"acknowledged": True, "acknowledged_at": datetime.now(timezone.utc)}}
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Alert not found")
+    dashboard_summary.alerts_acknowledged(1)
+    # The next occurrence should open a fresh alert, whichever worker coalesces it
+    alert_coalescer.close(alert_ack.alert_id)
+    broadcast_bus.publish({"kind": "alert_closed", "alert_ids": [alert_ack.alert_id]})
     return {"message": "Alert acknowledged"}
 
-@api_router.get("/dashboard/summary")
-async def get_dashboard_summary(current_user: User = Depends(get_current_user)):
-    # Get device count
-    device_count = await db.devices.count_documents({})
-    
-    # Get active alerts
-    active_alerts = await db.alerts.count_documents({"acknowledged": False})
+@api_router.post("/alerts/acknowledge/bulk")
+async def acknowledge_alerts(bulk_ack: AlertBulkAck, current_user: User = Depends(get_current_user)):
+    query = build_alerts_query(bulk_ack.device_id, bulk_ack.metric, bulk_ack.severity, bulk_ack.from_time, bulk_ack.to_time)
+    if bulk_ack.alert_ids is not None:
+        if not bulk_ack.alert_ids or len(bulk_ack.alert_ids) > 10000:
+            raise HTTPException(status_code=400, detail="alert_ids must hold between 1 and 10000 ids")
+        query["id"] = {"$in": bulk_ack.alert_ids}
+    if not query:
+        raise HTTPException(status_code=400, detail="Specify alert_ids or at least one filter")
     
-    # Get latest readings
-    latest_readings = await db.sensor_readings.find().sort("timestamp", -1).limit(10).to_list(10)
-    
-    # Calculate average power consumption
-    if latest_readings:
-        avg_power = sum(reading['power_kw'] for reading in latest_readings) / len(latest_readings)
-    else:
-        avg_power = 0
+    result = await db.alerts.update_many(
+        {**query, "acknowledged": False},
+        {"$set": {"acknowledged": True, "acknowledged_at": datetime.now(timezone.utc)}}
+    )
+    dashboard_summary.alerts_acknowledged(result.modified_count)
     
+    # Close the coalescer entries this acknowledged, so their next occurrences open fresh alerts.
+    # Every worker holds its own open alerts, so the others check theirs against the same filter.
+    if result.modified_count:
+        acknowledged = {"device_id": bulk_ack.device_id, "metric": bulk_ack.metric,
+                        "severity": bulk_ack.severity, "alert_ids": bulk_ack.alert_ids}
+        await alert_coalescer.close_acknowledged(**acknowledged)
+        broadcast_bus.publish({"kind": "alert_closed", "filter": acknowledged})
+    return {"message": f"Acknowledged {result.modified_count} alerts", "acknowledged": result.modified_count}
+
+@api_router.get("/thresholds")
+async def get_thresholds(current_user: User = Depends(get_current_user)):
+    overrides = await db.threshold_overrides.find({}, {"_id": 0}).to_list(None)
     return {
-        "device_count": device_count,
-        "active_alerts": active_alerts,
-        "avg_power_kw": round(avg_power, 2),
-        "system_status": "operational"
+        "defaults": anomaly_detector.thresholds,
+        "overrides": [ThresholdConfig(**override) for override in overrides]
     }
 
+def validate_threshold_scope(device_id: Optional[str], device_type: Optional[str], metric: str):
+    if bool(device_id) == bool(device_type):
+        raise HTTPException(status_code=400, detail="Specify exactly one of device_id or device_type")
+    if metric not in THRESHOLD_METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(THRESHOLD_METRICS)}")
+    if device_id and device_registry.get(device_id) is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+@api_router.put("/thresholds", response_model=ThresholdConfig)
+async def set_threshold(config: ThresholdConfig, current_user: User = Depends(require_role(["admin", "manager"]))):
+    validate_threshold_scope(config.device_id, config.device_type, config.metric)
+    if config.min_threshold is None and config.max_threshold is None:
+        raise HTTPException(status_code=400, detail="Specify min_threshold and/or max_threshold")
+    if config.min_threshold is not None and config.max_threshold is not None and config.min_threshold >= config.max_threshold:
+        raise HTTPException(status_code=400, detail="min_threshold must be below max_threshold")
+    
+    await db.threshold_overrides.replace_one(
+        {"device_id": config.device_id, "device_type": config.device_type, "metric": config.metric},
+        config.dict(),
+        upsert=True
+    )
+    anomaly_detector.apply_threshold_override(config)
+    broadcast_bus.publish({"kind": "threshold_override", "config": config.dict()})
+    return config
+
+@api_router.delete("/thresholds")
+async def delete_threshold(
+    metric: str,
+    device_id: Optional[str] = None,
+    device_type: Optional[str] = None,
+    current_user: User = Depends(require_role(["admin", "manager"]))
+):
+    validate_threshold_scope(device_id, device_type, metric)
+    result = await db.threshold_overrides.delete_one({"device_id": device_id, "device_type": device_type, "metric": metric})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Threshold override not found")
+    config = ThresholdConfig(device_id=device_id, device_type=device_type, metric=metric)
+    anomaly_detector.apply_threshold_override(config, remove=True)
+    broadcast_bus.publish({"kind": "threshold_override", "config": config.dict(), "remove": True})
+    return {"message": "Threshold override removed"}
+
+@api_router.get("/dashboard/summary")
+async def get_dashboard_summary(current_user: User = Depends(get_current_user)):
+    # Served from memory; see DashboardSummary for how it is kept current
+    return dashboard_summary.snapshot()
+
 @api_router.post("/simulation/start")
-async def start_simulation(current_user: User = Depends(require_role(["admin", "manager"]))):
+async def start_simulation(
+    config: Optional[SimulationConfig] = None,
+    current_user: User = Depends(require_role(["admin", "manager"]))
+):
     if not simulator.running:
+        # Unset fields keep the current configuration; counters and the seeded generator restart
+        config = config or SimulationConfig()
+        if config.device_count is not None and config.device_count < 0:
+            raise HTTPException(status_code=400, detail="device_count must not be negative")
+        if config.tick_seconds is not None and config.tick_seconds <= 0:
+            raise HTTPException(status_code=400, detail="tick_seconds must be positive")
+        if config.anomaly_rate is not None and not 0 <= config.anomaly_rate <= 1:
+            raise HTTPException(status_code=400, detail="anomaly_rate must be between 0 and 1")
+        simulator.configure(
+            config.device_count if config.device_count is not None else simulator.device_count,
+            config.tick_seconds or simulator.tick_seconds,
+            config.anomaly_rate if config.anomaly_rate is not None else simulator.anomaly_rate,
+            config.seed if config.seed is not None else simulator.seed
+        )
         await simulator.initialize_devices()
         simulator.running = True
         # Start simulation in background
@@ -483,16 +3274,46 @@ async def stop_simulation(current_user: User = Depends(require_role(["admin", "m
     simulator.running = False
     return {"message": "Simulation stopped"}
 
+@api_router.get("/simulation/status")
+async def get_simulation_status(current_user: User = Depends(get_current_user)):
+    return simulator.stats()
+
 # WebSocket endpoint
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = None):
+    # Browsers cannot set headers on a WebSocket handshake, so the token may come as ?token=
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    try:
+        user = await authenticate_token(token or "")
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await manager.connect(websocket, user)
     try:
         while True:
             data = await websocket.receive_text()
-            # Handle websocket messages if needed
-            await websocket.send_text(f"Message received: {data}")
+            try:
+                request = json.loads(data)
+            except ValueError:
+                request = None
+            if isinstance(request, dict) and request.get("action") in ("subscribe", "unsubscribe"):
+                try:
+                    subscription = manager.subscribe(websocket, request if request["action"] == "subscribe" else {})
+                except ValueError as e:
+                    await manager.send(websocket, json.dumps({"type": "error", "detail": str(e)}))
+                    continue
+                await manager.send(websocket, json.dumps({"type": "subscribed", "subscription": subscription}))
+                if "dashboard_summary" in (request.get("types") or ()):
+                    # Start from the current snapshot rather than waiting for the next push
+                    await manager.send(websocket, json.dumps({"type": "dashboard_summary", "data": dashboard_summary.snapshot()}), "dashboard_summary")
+            else:
+                await manager.send(websocket, f"Message received: {data}")
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, the client's indexes and writer task go with it
         manager.disconnect(websocket)
 
 # Include the router in the main app
@@ -504,6 +3325,8 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Paginated endpoints return their next-page cursor in this header
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Configure logging
@@ -516,6 +3339,23 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_event():
     logger.info("Smart Industrial Energy Monitoring System starting up...")
+    await ensure_storage_layout()
+    await retention_manager.apply_policies()
+    await verify_query_plans(os.environ.get('QUERY_PLAN_CHECK', 'warn'))
+    await EquipmentSimulator.mark_virtual_devices()
+    await device_registry.load()
+    device_registry.start()
+    await latest_readings.load()
+    await anomaly_detector.load_threshold_overrides()
+    await alert_coalescer.load()
+    await broadcast_bus.start()
+    write_buffer.start()
+    if anomaly_detector.online:
+        await anomaly_detector.online.load()
+    anomaly_detector.start()
+    retention_manager.start()
+    await dashboard_summary.reconcile()
+    dashboard_summary.start()
     # Create default admin user if not exists
     admin_user = await db.users.find_one({"username": "admin"})
     if not admin_user:
@@ -536,4 +3376,10 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_db_client():
     simulator.running = False
+    await write_buffer.stop()
+    await anomaly_detector.stop()
+    await device_registry.stop()
+    await broadcast_bus.stop()
+    await retention_manager.stop()
+    await dashboard_summary.stop()
     client.close()
\ No newline at end of file
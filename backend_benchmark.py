@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Smart Industrial Energy Monitoring System - Backend Benchmark
+Runs the FastAPI app in-process against an in-memory Mongo stand-in (mongomock-motor)
+or a local mongod, drives ingest, metrics, dashboard summary and WebSocket fan-out with
+configurable concurrency, and writes latency percentiles, throughput and memory to JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+ROOT_DIR = Path(__file__).parent
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the energy monitoring backend in-process")
+    parser.add_argument("--mongo-url", help="Use a local mongod instead of the in-memory stand-in")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent HTTP clients")
+    parser.add_argument("--devices", type=int, default=20, help="Devices created for ingest")
+    parser.add_argument("--ingest-requests", type=int, default=400)
+    parser.add_argument("--ingest-batch", type=int, default=50, help="Readings per ingest request")
+    parser.add_argument("--query-requests", type=int, default=200, help="Requests per query scenario")
+    parser.add_argument("--ws-clients", type=int, default=50)
+    parser.add_argument("--ws-devices", type=int, default=100, help="Simulated devices during fan-out")
+    parser.add_argument("--ws-tick-seconds", type=float, default=0.5)
+    parser.add_argument("--ws-seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def memory_mb() -> Dict[str, float]:
+    """Current and peak resident set size of this process (server and load generator)"""
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        rss = None
+    return {"rss_mb": round(rss, 1) if rss is not None else None, "peak_rss_mb": round(peak_kb / 1024, 1)}
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "max_ms": round(max(latencies) * 1000, 2)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BackendBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = np.random.default_rng(args.seed)
+        self.results: Dict[str, Any] = {}
+        self.server = None
+        self.base_url = None
+        self.token = None
+        self.device_ids: List[str] = []
+
+    def start_server(self):
+        """Import the app with the selected Mongo backend and serve it from a background thread"""
+        os.environ["MONGO_URL"] = self.args.mongo_url or "mongodb://localhost:27017"
+        os.environ["DB_NAME"] = f"energy_benchmark_{int(time.time())}"
+        if not self.args.mongo_url:
+            # The stand-in has no explain(), time-series collections or change streams
+            os.environ["QUERY_PLAN_CHECK"] = "off"
+        sys.path.insert(0, str(ROOT_DIR / "backend"))
+        import server as app_module
+        if not self.args.mongo_url:
+            from mongomock_motor import AsyncMongoMockClient
+            app_module.client = AsyncMongoMockClient()
+            app_module.db = app_module.client[os.environ["DB_NAME"]]
+        self.app_module = app_module
+        # Per-request client logs would drown the report
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        import uvicorn
+        port = free_port()
+        config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        threading.Thread(target=self.server.run, daemon=True).start()
+        while not self.server.started:
+            time.sleep(0.05)
+        self.base_url = f"http://127.0.0.1:{port}"
+        print(f"Backend serving at {self.base_url} ({self.args.mongo_url or 'in-memory Mongo stand-in'})")
+
+    def stop_server(self):
+        if self.server:
+            self.server.should_exit = True
+        if self.args.mongo_url:
+            # Drop the throwaway database
+            from pymongo import MongoClient
+            MongoClient(self.args.mongo_url).drop_database(os.environ["DB_NAME"])
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def setup(self, http):
+        response = await http.post("/api/auth/login", json={"username": "admin", "password": "admin123"})
+        response.raise_for_status()
+        self.token = response.json()["access_token"]
+        device_types = ["motor", "compressor", "hvac", "conveyor"]
+        for index in range(self.args.devices):
+            response = await http.post("/api/devices", headers=self.headers, json={
+                "name": f"Bench-{index:04d}",
+                "type": device_types[index % len(device_types)],
+                "location": f"Bench Line {index % 5 + 1}"
+            })
+            response.raise_for_status()
+            self.device_ids.append(response.json()["id"])
+
+    async def run_requests(self, name: str, total: int, request: Callable, units_per_request: int = 1) -> dict:
+        """Issue `total` requests from `concurrency` workers and summarize their latency"""
+        latencies: List[float] = []
+        failures = 0
+        remaining = total
+
+        async def worker():
+            nonlocal remaining, failures
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                response = await request()
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - started
+        result = {
+            "requests": total,
+            "failures": failures,
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(total / elapsed, 1),
+            **latency_summary(latencies),
+            **memory_mb()
+        }
+        if units_per_request > 1:
+            result["readings_per_second"] = round(total * units_per_request / elapsed, 1)
+        print(f"  {name}: {result['requests_per_second']} req/s, p50 {result['p50_ms']} ms, "
+              f"p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, failures {failures}")
+        return result
+
+    def ingest_payload(self) -> List[dict]:
+        batch = self.args.ingest_batch
+        device_ids = self.rng.choice(self.device_ids, size=batch)
+        # Values inside the default thresholds, so the run measures ingest rather than alerting
+        values = self.rng.uniform([10, 40, 1.0, 5], [30, 60, 3.0, 15], size=(batch, 4)).round(2)
+        return [
+            {"device_id": device_id, "power_kw": row[0], "temperature_c": row[1], "vibration": row[2], "runtime_hours": row[3]}
+            for device_id, row in zip(device_ids.tolist(), values.tolist())
+        ]
+
+    async def benchmark_ingest(self, http):
+        result = await self.run_requests(
+            "sensor-ingest", self.args.ingest_requests,
+            lambda: http.post("/api/sensor-ingest", headers=self.headers, json=self.ingest_payload()),
+            units_per_request=self.args.ingest_batch
+        )
+        # Ingest is write-behind; also time how long storage takes to catch up
+        started = time.perf_counter()
+        while (await http.get("/api/system/stats", headers=self.headers)).json()["write_buffer"]["queue_depth"]:
+            await asyncio.sleep(0.05)
+        result["drain_seconds"] = round(time.perf_counter() - started, 3)
+        self.results["ingest"] = result
+
+    async def benchmark_queries(self, http):
+        total = self.args.query_requests
+        self.results["metrics_latest"] = await self.run_requests(
+            "metrics (latest)", total, lambda: http.get("/api/metrics", headers=self.headers))
+        self.results["metrics_bucketed"] = await self.run_requests(
+            "metrics (1m buckets)", total, lambda: http.get("/api/metrics?bucket=1m", headers=self.headers))
+        self.results["dashboard_summary"] = await self.run_requests(
+            "dashboard summary", total, lambda: http.get("/api/dashboard/summary", headers=self.headers))
+
+    async def benchmark_fanout(self, http):
+        import websockets
+        url = self.base_url.replace("http", "ws", 1) + f"/ws?token={self.token}"
+        latencies: List[float] = []
+        received = 0
+        stop = asyncio.Event()
+
+        async def reader(connection):
+            nonlocal received
+            while not stop.is_set():
+                try:
+                    message = json.loads(await asyncio.wait_for(connection.recv(), timeout=0.5))
+                except asyncio.TimeoutError:
+                    continue
+                except Exception:
+                    return
+                if isinstance(message, dict) and message.get("type") == "sensor_reading":
+                    sent_at = datetime.fromisoformat(message["data"]["timestamp"])
+                    latencies.append((datetime.now(timezone.utc) - sent_at).total_seconds())
+                    received += 1
+
+        connections = [await websockets.connect(url, max_queue=None) for _ in range(self.args.ws_clients)]
+        readers = [asyncio.create_task(reader(connection)) for connection in connections]
+        response = await http.post("/api/simulation/start", headers=self.headers, json={
+            "device_count": self.args.ws_devices,
+            "tick_seconds": self.args.ws_tick_seconds,
+            "seed": self.args.seed
+        })
+        response.raise_for_status()
+        await asyncio.sleep(self.args.ws_seconds)
+        await http.post("/api/simulation/stop", headers=self.headers)
+        # Let in-flight messages land before counting
+        await asyncio.sleep(1)
+        stop.set()
+        await asyncio.gather(*readers)
+        stats = (await http.get("/api/system/stats", headers=self.headers)).json()
+        for connection in connections:
+            await connection.close()
+
+        simulator = stats["simulator"]
+        result = {
+            "clients": self.args.ws_clients,
+            "devices": self.args.ws_devices,
+            "seconds": self.args.ws_seconds,
+            "messages_received": received,
+            "messages_per_second": round(received / self.args.ws_seconds, 1),
+            "expected_messages": simulator["readings"] * self.args.ws_clients,
+            "dropped": stats["websocket"]["dropped"],
+            "simulator_target_readings_per_second": simulator["target_readings_per_second"],
+            "simulator_achieved_readings_per_second": simulator["achieved_readings_per_second"],
+            **latency_summary(latencies),
+            **memory_mb()
+        }
+        print(f"  ws fan-out: {result['messages_per_second']} msg/s to {result['clients']} clients, "
+              f"p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, dropped {result['dropped']}")
+        self.results["ws_fanout"] = result
+
+    async def run(self):
+        import httpx
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=60,
+                                     limits=httpx.Limits(max_connections=self.args.concurrency)) as http:
+            await self.setup(http)
+            print("\n=== Benchmarking ===")
+            await self.benchmark_ingest(http)
+            await self.benchmark_queries(http)
+            await self.benchmark_fanout(http)
+
+    def compare(self, baseline_path: str):
+        """Print p95 latency and throughput changes against an earlier run"""
+        with open(baseline_path) as f:
+            baseline = json.load(f)["scenarios"]
+        print(f"\n=== Compared with {baseline_path} ===")
+        for name, result in self.results.items():
+            previous = baseline.get(name)
+            if not previous:
+                continue
+            changes = []
+            for key in ("p95_ms", "requests_per_second", "readings_per_second", "messages_per_second"):
+                if result.get(key) and previous.get(key):
+                    change = (result[key] - previous[key]) / previous[key] * 100
+                    changes.append(f"{key} {previous[key]} -> {result[key]} ({change:+.1f}%)")
+            print(f"  {name}: {', '.join(changes)}")
+
+    def write_results(self):
+        report = {
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "mongo": "local mongod" if self.args.mongo_url else "mongomock-motor",
+            "config": {key: value for key, value in vars(self.args).items() if key not in ("mongo_url", "output", "baseline")},
+            "scenarios": self.results,
+            "memory": memory_mb()
+        }
+        with open(self.args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {self.args.output}")
+
+
+if __name__ == "__main__":
+    benchmark = BackendBenchmark(parse_args())
+    benchmark.start_server()
+    try:
+        asyncio.run(benchmark.run())
+    finally:
+        benchmark.stop_server()
+    if benchmark.args.baseline:
+        benchmark.compare(benchmark.args.baseline)
+    benchmark.write_results()
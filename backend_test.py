@@ -5,6 +5,7 @@ Tests all core backend functionality including authentication, device management
 sensor data simulation, alerts, and dashboard summary.
 """
 
+import asyncio
 import requests
 import json
 import time
@@ -297,6 +298,165 @@ class BackendTester:
         except Exception as e:
             self.log_test("Get Alerts", False, f"Request failed: {str(e)}")
     
+    def test_device_state(self):
+        """Test the last-value cache endpoint"""
+        print("\n=== Testing Device State ===")
+        
+        try:
+            response = self.make_request("GET", "/devices/state", use_auth=True)
+            
+            if response.status_code == 200:
+                states = response.json()
+                with_readings = [state for state in states if state.get("reading")]
+                if all("device_id" in state and "reading" in state for state in states):
+                    self.log_test(
+                        "Device State", 
+                        True, 
+                        f"Retrieved state of {len(states)} devices, {len(with_readings)} with a latest reading"
+                    )
+                else:
+                    self.log_test("Device State", False, "Device state entries missing device_id or reading", states[:1])
+            else:
+                self.log_test("Device State", False, f"Failed with status {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Device State", False, f"Request failed: {str(e)}")
+    
+    def test_thresholds(self):
+        """Test threshold override create, read and delete"""
+        print("\n=== Testing Threshold Overrides ===")
+        
+        override = {"device_type": "conveyor", "metric": "power_kw", "max_threshold": 20.0}
+        
+        try:
+            response = self.make_request("PUT", "/thresholds", override, use_auth=True)
+            if response.status_code == 200:
+                self.log_test("Set Threshold Override", True, f"Override stored: {response.json()}")
+            else:
+                self.log_test("Set Threshold Override", False, f"Failed with status {response.status_code}: {response.text}")
+            
+            response = self.make_request("GET", "/thresholds", use_auth=True)
+            if response.status_code == 200:
+                overrides = response.json()["overrides"]
+                found = any(item["device_type"] == "conveyor" and item["metric"] == "power_kw" and item["max_threshold"] == 20.0
+                            for item in overrides)
+                self.log_test("Get Thresholds", found, f"Override {'listed' if found else 'missing'} among {len(overrides)} overrides")
+            else:
+                self.log_test("Get Thresholds", False, f"Failed with status {response.status_code}: {response.text}")
+            
+            response = self.make_request("PUT", "/thresholds", {"device_type": "conveyor", "metric": "power_kw"}, use_auth=True)
+            self.log_test("Reject Empty Override", response.status_code == 400, f"Override without bounds returned {response.status_code}")
+            
+            response = self.make_request("DELETE", "/thresholds?device_type=conveyor&metric=power_kw", use_auth=True)
+            self.log_test("Delete Threshold Override", response.status_code == 200, f"Delete returned {response.status_code}")
+            
+            response = self.make_request("DELETE", "/thresholds?device_type=conveyor&metric=power_kw", use_auth=True)
+            self.log_test("Delete Missing Override", response.status_code == 404, f"Second delete returned {response.status_code}")
+            
+        except Exception as e:
+            self.log_test("Threshold Overrides", False, f"Request failed: {str(e)}")
+    
+    def test_metrics_export(self):
+        """Test streaming export and resuming it from the last row"""
+        print("\n=== Testing Metrics Export ===")
+        
+        try:
+            response = self.make_request("GET", "/metrics/export?format=ndjson", use_auth=True)
+            
+            if response.status_code != 200:
+                self.log_test("Export Metrics", False, f"Failed with status {response.status_code}: {response.text}")
+                return
+            rows = [json.loads(line) for line in response.text.splitlines() if line]
+            self.log_test("Export Metrics", True, f"Exported {len(rows)} readings as NDJSON")
+            
+            if len(rows) >= 2:
+                # Resuming after a row must return exactly the rows that followed it, ties included
+                middle = rows[len(rows) // 2]
+                resumed = requests.get(
+                    f"{self.base_url}/metrics/export",
+                    params={"after": middle["timestamp"], "after_id": middle["id"]},
+                    headers={"Authorization": f"Bearer {self.token}"},
+                    timeout=30
+                )
+                resumed_ids = [json.loads(line)["id"] for line in resumed.text.splitlines() if line]
+                expected_ids = [row["id"] for row in rows[len(rows) // 2 + 1:]]
+                # Readings written after the first export may follow the expected ones
+                success = resumed.status_code == 200 and resumed_ids[:len(expected_ids)] == expected_ids
+                self.log_test("Resume Export", success, f"Resumed export returned {len(resumed_ids)} readings, expected at least {len(expected_ids)}")
+            else:
+                self.log_test("Resume Export", True, "Not enough readings to test resuming")
+                
+        except Exception as e:
+            self.log_test("Export Metrics", False, f"Request failed: {str(e)}")
+    
+    def test_alert_pagination_and_bulk_ack(self):
+        """Test keyset pagination of alerts and bulk acknowledgement"""
+        print("\n=== Testing Alert Pagination and Bulk Acknowledge ===")
+        
+        try:
+            response = self.make_request("GET", "/alerts?limit=1", use_auth=True)
+            if response.status_code == 200:
+                cursor = response.headers.get("X-Next-Cursor")
+                detail = f"First page has {len(response.json())} alerts"
+                if cursor:
+                    next_page = self.make_request("GET", f"/alerts?limit=1&cursor={cursor}", use_auth=True)
+                    overlap = {alert["id"] for alert in response.json()} & {alert["id"] for alert in next_page.json()}
+                    success = next_page.status_code == 200 and not overlap
+                    self.log_test("Alert Pagination", success, f"{detail}; next page returned {next_page.status_code} without overlap" if success else f"{detail}; next page overlapped or failed")
+                else:
+                    self.log_test("Alert Pagination", True, f"{detail}; no further pages")
+            else:
+                self.log_test("Alert Pagination", False, f"Failed with status {response.status_code}: {response.text}")
+            
+            response = self.make_request("GET", "/alerts?cursor=not-a-cursor", use_auth=True)
+            self.log_test("Reject Invalid Cursor", response.status_code == 400, f"Invalid cursor returned {response.status_code}")
+            
+            response = self.make_request("POST", "/alerts/acknowledge/bulk", {}, use_auth=True)
+            self.log_test("Reject Unfiltered Bulk Acknowledge", response.status_code == 400, f"Empty filter returned {response.status_code}")
+            
+            response = self.make_request("POST", "/alerts/acknowledge/bulk", {"severity": "low"}, use_auth=True)
+            if response.status_code == 200:
+                acknowledged = response.json()["acknowledged"]
+                remaining = self.make_request("GET", "/alerts?severity=low&acknowledged=false", use_auth=True).json()
+                # Alerts raised in between may appear, but far fewer than were just acknowledged
+                self.log_test("Bulk Acknowledge", True, f"Acknowledged {acknowledged} low-severity alerts, {len(remaining)} open since")
+            else:
+                self.log_test("Bulk Acknowledge", False, f"Failed with status {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Alert Bulk Acknowledge", False, f"Request failed: {str(e)}")
+    
+    def test_websocket_auth(self):
+        """Test that the WebSocket requires a valid access token"""
+        print("\n=== Testing WebSocket Authentication ===")
+        
+        try:
+            import websockets
+        except ImportError:
+            self.log_test("WebSocket Auth", False, "websockets package is not installed")
+            return
+        ws_url = self.base_url[:-len("/api")].replace("http", "ws", 1) + "/ws"
+        
+        async def connect(url: str) -> str:
+            try:
+                async with websockets.connect(url, open_timeout=10) as connection:
+                    await connection.send(json.dumps({"action": "subscribe", "types": ["dashboard_summary"]}))
+                    await asyncio.wait_for(connection.recv(), timeout=10)
+                    return "accepted"
+            except Exception as e:
+                return f"rejected ({type(e).__name__})"
+        
+        for name, url, should_accept in [
+            ("WebSocket Without Token", ws_url, False),
+            ("WebSocket With Invalid Token", f"{ws_url}?token=invalid", False),
+            ("WebSocket With Token", f"{ws_url}?token={self.token}", True),
+        ]:
+            try:
+                outcome = asyncio.run(connect(url))
+                self.log_test(name, (outcome == "accepted") == should_accept, f"Connection {outcome}")
+            except Exception as e:
+                self.log_test(name, False, f"Connection attempt failed: {str(e)}")
+    
     def test_dashboard_summary(self):
         """Test dashboard summary endpoint"""
         print("\n=== Testing Dashboard Summary ===")
@@ -337,6 +497,11 @@ class BackendTester:
             self.test_device_management()
             self.test_simulation_and_sensor_data()
             self.test_alert_system()
+            self.test_alert_pagination_and_bulk_ack()
+            self.test_thresholds()
+            self.test_device_state()
+            self.test_metrics_export()
+            self.test_websocket_auth()
             self.test_dashboard_summary()
         else:
             print("\n❌ Authentication failed - skipping remaining tests")
@@ -0,0 +1,34 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads these at import time; the client it builds does not connect until used
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "energy_monitor_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import ClientConnection
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.close_code = None
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+@pytest.fixture
+def attach():
+    """Register a client with a ConnectionManager without starting its writer task"""
+    def attach(manager, request=None):
+        websocket = FakeWebSocket()
+        client = ClientConnection(websocket, manager.max_queue)
+        manager.clients[websocket] = client
+        manager.unscoped.add(client)
+        if request is not None:
+            manager.subscribe(websocket, request)
+        return client
+    return attach
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta, timezone
+
+from server import Alert, AlertCoalescer
+
+START = datetime(2025, 1, 16, 10, 0, tzinfo=timezone.utc)
+
+
+def alert(seconds, severity="high", metric="power_kw", device_id="d"):
+    return Alert(device_id=device_id, alert_type="threshold_exceeded", metric=metric, value=60.0,
+                 threshold=50.0, severity=severity, message="power_kw over", timestamp=START + timedelta(seconds=seconds))
+
+
+def test_repeats_inside_the_window_become_one_counter_update():
+    coalescer = AlertCoalescer(window=300)
+    first, repeats = alert(0), [alert(100), alert(250)]
+    new_alerts, updates = coalescer.coalesce([first, *repeats])
+    assert new_alerts == [first] and first.last_seen == first.timestamp
+    assert [(update._filter, update._doc) for update in updates] == [(
+        {"id": first.id},
+        {"$inc": {"occurrences": 2}, "$max": {"last_seen": START + timedelta(seconds=250)}},
+    )]
+    assert (coalescer.created, coalescer.coalesced) == (1, 2)
+
+
+def test_the_window_slides_with_the_last_repeat():
+    coalescer = AlertCoalescer(window=300)
+    coalescer.coalesce([alert(0)])
+    assert coalescer.coalesce([alert(299)])[0] == []
+    assert coalescer.coalesce([alert(598)])[0] == []
+    reopened = alert(899)
+    assert coalescer.coalesce([reopened])[0] == [reopened]
+    assert coalescer.open_ids() == [reopened.id]
+
+
+def test_other_severities_metrics_and_devices_open_their_own_alerts():
+    coalescer = AlertCoalescer(window=300)
+    alerts = [alert(0), alert(1, severity="critical"), alert(2, metric="vibration"), alert(3, device_id="e")]
+    new_alerts, updates = coalescer.coalesce(alerts)
+    assert new_alerts == alerts and updates == []
+    assert coalescer.open_ids(device_id="d", metric="power_kw", severity="high") == [alerts[0].id]
+
+
+def test_closing_an_alert_makes_the_next_repeat_a_new_alert():
+    coalescer = AlertCoalescer(window=300)
+    first = alert(0)
+    coalescer.coalesce([first])
+    coalescer.close(first.id)
+    repeat = alert(10)
+    assert coalescer.coalesce([repeat]) == ([repeat], [])
+    assert coalescer.keys_by_id.keys() == {repeat.id}
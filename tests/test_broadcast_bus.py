@@ -0,0 +1,44 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import Alert, AlertCoalescer, BroadcastBus, ConnectionManager, Device, DeviceRegistry, LatestReadings
+
+
+@pytest.fixture(autouse=True)
+def worker(monkeypatch):
+    registry = DeviceRegistry()
+    registry.add(Device(id="m1", name="Motor 1", type="motor", location="Plant A"))
+    monkeypatch.setattr(server, "device_registry", registry)
+    monkeypatch.setattr(server, "manager", ConnectionManager())
+    monkeypatch.setattr(server, "latest_readings", LatestReadings())
+    monkeypatch.setattr(server, "alert_coalescer", AlertCoalescer())
+
+
+def reading(device_id):
+    return {"id": f"r-{device_id}", "device_id": device_id, "timestamp": datetime.now(timezone.utc), "power_kw": 25.0}
+
+
+def test_a_relayed_tick_reaches_subscribers_and_the_cache(attach):
+    client = attach(server.manager, {"device_ids": ["m1"]})
+    BroadcastBus().dispatch({"kind": "readings", "readings": [reading("m1"), reading("v1")], "device_names": ["Motor 1", "Virtual 1"]})
+    messages = [json.loads(client.queue.get_nowait()[0]) for _ in range(client.queue.qsize())]
+    assert [(message["type"], message["device_name"]) for message in messages] == [("sensor_reading", "Motor 1")]
+    assert server.latest_readings.readings.keys() == {"m1", "v1"}
+
+
+def test_relayed_ingest_batches_only_feed_the_cache(attach):
+    client = attach(server.manager)
+    BroadcastBus().dispatch({"kind": "readings", "readings": [reading("m1")]})
+    assert client.queue.empty()
+    assert server.latest_readings.readings.keys() == {"m1"}
+
+
+def test_an_alert_acknowledged_on_another_worker_closes_the_local_entry():
+    alert = Alert(device_id="m1", alert_type="threshold_exceeded", metric="power_kw", value=60.0, threshold=50.0,
+                  severity="high", message="power_kw over", timestamp=datetime.now(timezone.utc))
+    server.alert_coalescer.coalesce([alert])
+    BroadcastBus().dispatch({"kind": "alert_closed", "alert_ids": [alert.id]})
+    assert server.alert_coalescer.open == {}
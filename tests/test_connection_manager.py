@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from server import ConnectionManager
+
+
+def queued(client):
+    return [json.loads(client.queue.get_nowait()[0])["n"] for _ in range(client.queue.qsize())]
+
+
+def test_messages_are_queued_per_client(attach):
+    manager = ConnectionManager(max_queue=10)
+    clients = [attach(manager), attach(manager)]
+    for n in range(3):
+        manager.deliver({"type": "dashboard_summary", "n": n})
+    assert [queued(client) for client in clients] == [[0, 1, 2], [0, 1, 2]]
+    assert manager.messages == 3
+
+
+def test_conflate_drops_the_oldest_state_update_of_a_full_queue(attach):
+    manager = ConnectionManager(max_queue=2, slow_client_policy="conflate")
+    client = attach(manager)
+    client.needs_keyframe = False
+    for n in range(5):
+        manager.deliver({"type": "dashboard_summary", "n": n})
+    assert queued(client) == [3, 4]
+    assert (client.dropped, manager.dropped) == (3, 3)
+    # Only a dropped frame breaks the delta baseline
+    assert not client.needs_keyframe
+
+
+def test_conflate_never_drops_alerts(attach):
+    manager = ConnectionManager(max_queue=3, slow_client_policy="conflate")
+    client = attach(manager)
+    manager.deliver({"type": "alert", "n": 0})
+    manager.deliver({"type": "dashboard_summary", "n": 1})
+    manager.deliver({"type": "alert", "n": 2})
+    manager.deliver({"type": "alert", "n": 3})
+    assert queued(client) == [0, 2, 3]
+    assert client.websocket in manager.clients and manager.dropped == 1
+
+
+def test_conflate_disconnects_a_client_backed_up_with_alerts(attach):
+    manager = ConnectionManager(max_queue=2, slow_client_policy="conflate")
+
+    async def run():
+        client = attach(manager)
+        for n in range(3):
+            manager.deliver({"type": "alert", "n": n})
+        await asyncio.sleep(0)
+        return client
+
+    client = asyncio.run(run())
+    assert client.websocket not in manager.clients and client.websocket.close_code == 1013
+    assert (manager.pruned, manager.dropped) == (1, 0)
+
+
+def test_disconnect_policy_removes_and_closes_a_slow_client(attach):
+    manager = ConnectionManager(max_queue=2, slow_client_policy="disconnect")
+
+    async def run():
+        slow, other = attach(manager), attach(manager)
+        slow.queue.put_nowait(("backlog", "dashboard_summary"))
+        slow.queue.put_nowait(("backlog", "dashboard_summary"))
+        manager.deliver({"type": "dashboard_summary", "n": 0})
+        await asyncio.sleep(0)
+        return slow, other
+
+    slow, other = asyncio.run(run())
+    assert slow.websocket not in manager.clients and slow not in manager.unscoped
+    assert slow.websocket.close_code == 1013
+    assert manager.pruned == 1
+    assert queued(other) == [0]
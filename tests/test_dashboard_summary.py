@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import DashboardSummary, LatestReadings, WriteBehindBuffer
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = mongomock_motor.AsyncMongoMockClient().db
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "write_buffer", WriteBehindBuffer())
+    monkeypatch.setattr(server, "latest_readings", LatestReadings())
+    return database
+
+
+def reading(index, power_kw, timestamp, device_id=None):
+    return {"id": f"r{index}", "device_id": device_id or f"d{index}", "timestamp": timestamp, "power_kw": power_kw,
+            "temperature_c": 50.0, "vibration": 2.0, "runtime_hours": 1.0}
+
+
+def test_reconcile_counts_queued_changes_exactly_once(db):
+    summary = DashboardSummary()
+    now = datetime.now(timezone.utc)
+
+    async def run():
+        # Written by another worker, so this one has not counted them
+        await db.alerts.insert_many([{"id": "old-1", "acknowledged": False}, {"id": "old-2", "acknowledged": False}])
+        sequence = await server.write_buffer.put_many("alerts", [{"id": f"new-{index}", "acknowledged": False} for index in range(3)])
+        summary.alerts_opened(3, sequence)
+        readings = [reading(index, 10.0 * (index + 1), now) for index in range(4)]
+        server.latest_readings.update(readings)
+        sequence = await server.write_buffer.put_many("sensor_readings", readings)
+        summary.observe_readings([document["power_kw"] for document in readings], sequence, now)
+
+        # Writes are still queued, yet the round goes ahead
+        assert await summary.reconcile()
+        queued = summary.snapshot()
+        await server.write_buffer.stop()
+        assert await summary.reconcile()
+        return queued, summary.snapshot()
+
+    queued, flushed = asyncio.run(run())
+    for snapshot in (queued, flushed):
+        assert snapshot["active_alerts"] == 5
+        assert snapshot["avg_power_kw"] == 25.0
+        assert snapshot["avg_power_kw_24h"] == 25.0
+    assert summary.corrections == 1 and summary.skipped == 0
+    assert len(summary.in_flight) == 0
+
+
+
+def test_reconcile_takes_the_current_average_from_the_last_value_cache(db):
+    summary = DashboardSummary(latest_size=2)
+    now = datetime.now(timezone.utc)
+    server.latest_readings.update([reading(0, 10.0, now - timedelta(seconds=2)), reading(1, 20.0, now - timedelta(seconds=1)),
+                                   reading(2, 30.0, now), reading(3, 90.0, now - timedelta(seconds=5), device_id="d2")])
+    # Raw readings in Mongo are never queried for it
+    asyncio.run(db.sensor_readings.insert_one(reading(4, 1000.0, now + timedelta(seconds=1))))
+    assert asyncio.run(summary.reconcile())
+    assert summary.snapshot()["avg_power_kw"] == 25.0
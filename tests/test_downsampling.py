@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from server import ReadingRollups, aggregate_buckets, lttb_downsample, lttb_indices
+
+
+def test_short_series_are_returned_whole():
+    x = np.arange(5, dtype=float)
+    assert lttb_indices(x, x, 10).tolist() == [0, 1, 2, 3, 4]
+    assert lttb_indices(x, x, 2).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_keeps_endpoints_and_returns_threshold_sorted_points():
+    rng = np.random.default_rng(7)
+    x = np.arange(1000, dtype=float)
+    y = rng.normal(size=1000)
+    indices = lttb_indices(x, y, 50)
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_preserves_a_spike():
+    x = np.arange(500, dtype=float)
+    y = np.zeros(500)
+    y[321] = 100.0
+    assert 321 in lttb_indices(x, y, 20).tolist()
+
+
+def test_downsampled_points_carry_utc_timestamps():
+    # Mongo returns naive UTC datetimes
+    frame = pd.DataFrame({
+        "device_id": "d",
+        "timestamp": pd.date_range("2025-01-16 10:00", periods=120, freq="30s"),
+        "power_kw": np.linspace(10, 20, 120),
+    })
+    rollups = frame.rename(columns={"power_kw": "power_kw_sum"}).assign(
+        count=1, power_kw_min=frame["power_kw"], power_kw_max=frame["power_kw"])
+    outputs = [
+        aggregate_buckets(frame, "15min", ["avg"], ["power_kw"]),
+        ReadingRollups.aggregate(rollups, "15min", ["avg"], ["power_kw"]),
+        lttb_downsample(frame, 10, "power_kw"),
+    ]
+    for points in outputs:
+        assert points[0]["timestamp"] == "2025-01-16T10:00:00+00:00"
+        assert all(point["timestamp"].endswith("+00:00") for point in points)
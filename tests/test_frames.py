@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import msgpack
+import pytest
+
+import server
+from server import SENSOR_METRICS, ConnectionManager, Device, DeviceRegistry
+
+
+@pytest.fixture(autouse=True)
+def devices(monkeypatch):
+    registry = DeviceRegistry()
+    for device_id in ("m1", "m2"):
+        registry.add(Device(id=device_id, name=device_id, type="motor", location="Plant A"))
+    monkeypatch.setattr(server, "device_registry", registry)
+
+
+def reading(power_kw, temperature_c=50.0):
+    return {"power_kw": power_kw, "temperature_c": temperature_c, "vibration": 2.0, "runtime_hours": 1.0}
+
+
+def flush(manager, staged):
+    async def stage_and_flush():
+        for device_id, values in staged:
+            manager.stage_reading(device_id, values)
+        manager.flush_frames()
+    asyncio.run(stage_and_flush())
+
+
+def frames(client):
+    payloads = [client.queue.get_nowait()[0] for _ in range(client.queue.qsize())]
+    return [msgpack.unpackb(payload) if isinstance(payload, bytes) else json.loads(payload) for payload in payloads]
+
+
+def test_deltas_carry_only_changed_fields_after_a_keyframe(attach):
+    manager = ConnectionManager()
+    client = attach(manager, {"frames": True, "delta": True})
+    flush(manager, [("m1", reading(10.0)), ("m2", reading(20.0))])
+    flush(manager, [("m1", reading(11.0)), ("m2", reading(20.0))])
+    keyframe, delta = frames(client)
+    assert keyframe["keyframe"] and keyframe["fields"] == SENSOR_METRICS
+    assert keyframe["devices"] == {"m1": [10.0, 50.0, 2.0, 1.0], "m2": [20.0, 50.0, 2.0, 1.0]}
+    assert not delta["keyframe"] and delta["seq"] == keyframe["seq"] + 1
+    assert delta["devices"] == {"m1": {"power_kw": 11.0}}
+
+
+def test_a_keyframe_carries_the_whole_view_when_only_part_of_it_is_staged(attach):
+    manager = ConnectionManager()
+    attach(manager, {"frames": True})
+    flush(manager, [("m1", reading(10.0)), ("m2", reading(20.0))])
+    late = attach(manager, {"frames": True, "delta": True})
+    scoped = attach(manager, {"frames": True, "delta": True, "device_ids": ["m1", "m3"]})
+    flush(manager, [("m1", reading(11.0))])
+    (keyframe,) = frames(late)
+    assert keyframe["keyframe"] and keyframe["devices"] == {"m1": [11.0, 50.0, 2.0, 1.0], "m2": [20.0, 50.0, 2.0, 1.0]}
+    # Devices that never reported are left out until they do
+    assert frames(scoped)[0]["devices"] == {"m1": [11.0, 50.0, 2.0, 1.0]}
+
+
+def test_a_later_reading_in_the_window_replaces_the_earlier_one(attach):
+    manager = ConnectionManager()
+    client = attach(manager, {"frames": True})
+    flush(manager, [("m1", reading(10.0)), ("m1", reading(12.0, temperature_c=55.0))])
+    (frame,) = frames(client)
+    assert frame["devices"] == {"m1": [12.0, 55.0, 2.0, 1.0]}
+
+
+def test_a_frame_that_finds_the_queue_full_is_a_keyframe(attach):
+    manager = ConnectionManager(max_queue=1)
+    client = attach(manager, {"frames": True, "delta": True})
+    flush(manager, [("m1", reading(10.0))])
+    frames(client)
+    flush(manager, [("m1", reading(11.0))])
+    # The queued delta is dropped, so the client's baseline is lost
+    flush(manager, [("m1", reading(12.0))])
+    (frame,) = frames(client)
+    assert (frame["seq"], frame["keyframe"], frame["devices"]) == (3, True, {"m1": [12.0, 50.0, 2.0, 1.0]})
+    assert client.dropped == 1
+    flush(manager, [("m1", reading(13.0))])
+    assert frames(client)[0]["devices"] == {"m1": {"power_kw": 13.0}}
+
+
+def test_a_dropped_frame_makes_the_next_frame_a_keyframe(attach):
+    manager = ConnectionManager(max_queue=1)
+    client = attach(manager, {"frames": True, "delta": True})
+    flush(manager, [("m1", reading(10.0))])
+    frames(client)
+    flush(manager, [("m1", reading(11.0))])
+    manager.deliver({"type": "dashboard_summary"})
+    frames(client)
+    flush(manager, [("m1", reading(12.0))])
+    assert frames(client)[0]["keyframe"] is True
+
+
+def test_keyframes_are_repeated_every_interval(attach):
+    manager = ConnectionManager(keyframe_interval=3)
+    client = attach(manager, {"frames": True, "delta": True})
+    for power_kw in range(7):
+        flush(manager, [("m1", reading(float(power_kw)))])
+    assert [frame["keyframe"] for frame in frames(client)] == [True, False, True, False, False, True, False]
+
+
+def test_frames_follow_each_clients_view_and_encoding(attach):
+    manager = ConnectionManager()
+    packed = attach(manager, {"frames": True, "device_ids": ["m2"], "encoding": "msgpack"})
+    plain = attach(manager)
+    flush(manager, [("m1", reading(10.0)), ("m2", reading(20.0))])
+    (frame,) = frames(packed)
+    assert frame["devices"] == {"m2": [20.0, 50.0, 2.0, 1.0]}
+    # Clients outside frame mode get no frames, and frame clients no single readings
+    assert frames(plain) == []
+    manager.deliver({"type": "sensor_reading"}, "m2")
+    assert frames(packed) == []
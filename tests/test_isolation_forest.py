@@ -0,0 +1,44 @@
+import asyncio
+
+import numpy as np
+
+from server import AnomalyDetector, fit_isolation_forest
+
+
+def normal_readings(rng, size):
+    return rng.uniform([20.0, 45.0, 1.5], [30.0, 55.0, 2.5], size=(size, 3))
+
+
+def trained_detector(score_margin):
+    rng = np.random.default_rng(17)
+    samples = normal_readings(rng, 2000)
+    detector = AnomalyDetector(ml_enabled=True, score_margin=score_margin)
+    detector.models = {"motor": {
+        "model": fit_isolation_forest(samples, 0.01), "version": 1, "trained_at": 0.0,
+        "samples": len(samples), "mean": samples.mean(axis=0), "std": samples.std(axis=0),
+        "min": samples.min(axis=0), "max": samples.max(axis=0),
+    }}
+    return detector, normal_readings(rng, 20000)
+
+
+def flagged(detector, values):
+    return detector.score(detector.models, ["motor"] * len(values), ["m"] * len(values), values)
+
+
+def test_learned_stage_is_off_by_default():
+    detector = AnomalyDetector(online=None)
+    values = np.array([[25.0, 50.0, 2.0]] * 3)
+    assert asyncio.run(detector.analyze_matrix(["m"] * 3, ["motor"] * 3, values)) == []
+    assert detector.windows == {}
+
+
+def test_zero_margin_flags_about_the_contamination_share_of_normal_readings():
+    detector, values = trained_detector(score_margin=0.0)
+    assert 0.002 < len(flagged(detector, values)) / len(values) < 0.03
+
+
+def test_default_margin_keeps_normal_readings_quiet_but_flags_outliers():
+    detector, values = trained_detector(score_margin=AnomalyDetector().score_margin)
+    assert len(flagged(detector, values)) / len(values) < 0.005
+    alerts = flagged(detector, np.array([[60.0, 80.0, 5.0]]))
+    assert [(alert.metric, alert.alert_type) for alert in alerts] == [("power_kw", "anomaly_detected")]
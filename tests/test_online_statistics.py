@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from server import OnlineStatistics
+
+
+def test_repeated_devices_in_one_batch_match_sequential_updates():
+    rng = np.random.default_rng(3)
+    device_ids = ["a", "b", "a", "c", "a", "b"] * 5
+    values = rng.normal(50, 5, size=(len(device_ids), 3))
+    batched = OnlineStatistics(warmup=2, capacity=2)
+    sequential = OnlineStatistics(warmup=2, capacity=2)
+
+    batch_z, _, _ = batched.update(device_ids, values)
+    sequential_z = np.vstack([sequential.update([device_id], row[None, :])[0] for device_id, row in zip(device_ids, values)])
+
+    np.testing.assert_allclose(batch_z, sequential_z, equal_nan=True)
+    for device_id in "abc":
+        row, other = batched.index[device_id], sequential.index[device_id]
+        assert batched.count[row] == sequential.count[other]
+        np.testing.assert_allclose(batched.mean[row], sequential.mean[other])
+        np.testing.assert_allclose(batched.m2[row], sequential.m2[other])
+        np.testing.assert_allclose(batched.ewma[row], sequential.ewma[other])
+
+
+def test_welford_state_matches_numpy():
+    rng = np.random.default_rng(5)
+    values = rng.normal(20, 3, size=(40, 3))
+    device_ids = ["x", "y"] * 20
+    stats = OnlineStatistics()
+    stats.update(device_ids, values)
+    for device_id, samples in (("x", values[0::2]), ("y", values[1::2])):
+        row = stats.index[device_id]
+        assert stats.count[row] == 20
+        np.testing.assert_allclose(stats.mean[row], samples.mean(axis=0))
+        np.testing.assert_allclose(stats.m2[row] / (stats.count[row] - 1), samples.var(axis=0, ddof=1))
+
+
+def test_readings_score_against_the_state_before_them_and_only_once_warm():
+    stats = OnlineStatistics(warmup=3, z_limit=4.0)
+    baseline = np.array([[10.0, 50.0, 1.0], [12.0, 52.0, 1.2], [11.0, 51.0, 1.1]])
+    z_scores, _, _ = stats.update(["d"] * 3, baseline)
+    assert np.isnan(z_scores).all()
+    alerts = stats.score(["d"], np.array([[30.0, 51.0, 1.1]]))
+    assert [(alert.metric, alert.alert_type) for alert in alerts] == [("power_kw", "anomaly_detected")]
+    assert alerts[0].value == pytest.approx(30.0)
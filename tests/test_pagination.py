@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import KEYSET_SORT, KEYSET_SORT_ASCENDING, encode_cursor, keyset_after, keyset_query
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def readings():
+    collection = mongomock.MongoClient().db.readings
+    start = datetime(2025, 1, 16, 10, 0, tzinfo=timezone.utc)
+    # Groups of four readings share a timestamp, like one simulator tick
+    collection.insert_many([
+        {"id": f"r{index:02d}", "timestamp": start + timedelta(seconds=index // 4)}
+        for index in range(22)
+    ])
+    return collection
+
+
+def page_through(collection, limit, query=None):
+    seen, cursor = [], None
+    while True:
+        page = list(collection.find(keyset_query(query or {}, cursor)).sort(KEYSET_SORT).limit(limit))
+        seen.extend(document["id"] for document in page)
+        if len(page) < limit:
+            return seen
+        cursor = encode_cursor(page[-1])
+
+
+@pytest.mark.parametrize("limit", [1, 3, 4, 5, 22])
+def test_pages_cover_ties_exactly_once_in_order(readings, limit):
+    expected = [document["id"] for document in readings.find().sort(KEYSET_SORT)]
+    assert page_through(readings, limit) == expected
+
+
+def test_pages_combine_with_a_filter(readings):
+    query = {"id": {"$in": ["r01", "r02", "r05", "r06", "r07"]}}
+    assert page_through(readings, 2, query) == ["r07", "r06", "r05", "r02", "r01"]
+
+
+def test_ascending_resume_continues_after_a_tied_row(readings):
+    ordered = list(readings.find().sort(KEYSET_SORT_ASCENDING))
+    last = ordered[5]
+    rest = readings.find(keyset_after({}, last["timestamp"], last["id"], direction=1)).sort(KEYSET_SORT_ASCENDING)
+    assert [document["id"] for document in rest] == [document["id"] for document in ordered[6:]]
+
+
+def test_cursor_accepts_naive_timestamps_as_utc():
+    naive = {"timestamp": datetime(2025, 1, 16, 10, 0), "id": "a"}
+    aware = {"timestamp": datetime(2025, 1, 16, 10, 0, tzinfo=timezone.utc), "id": "a"}
+    assert encode_cursor(naive) == encode_cursor(aware)
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bm8tc2VwYXJhdG9y", "YmFkLWRhdGV8aWQ="])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        keyset_query({}, cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("export_format", ["ndjson", "csv"])
+def test_exports_write_stored_timestamps_as_utc(monkeypatch, export_format):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient().db
+    monkeypatch.setattr(server, "db", database)
+
+    async def export():
+        # Mongo hands datetimes back naive
+        await database.sensor_readings.insert_one({"id": "r", "device_id": "d", "timestamp": datetime(2025, 1, 16, 10, 15), "power_kw": 25.5})
+        return "".join([chunk async for chunk in server.stream_readings({}, export_format, 100)])
+
+    assert "2025-01-16T10:15:00+00:00" in asyncio.run(export())
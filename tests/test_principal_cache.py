@@ -0,0 +1,51 @@
+import pytest
+
+import server
+from server import PrincipalCache, User
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "time", lambda: now[0])
+    return now
+
+
+def user(username):
+    return User(username=username, email=f"{username}@company.com")
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = PrincipalCache(ttl=60)
+    cache.put("token", user("alice"))
+    clock[0] += 59
+    assert cache.get("token").username == "alice"
+    clock[0] += 1
+    assert cache.get("token") is None
+    assert (cache.hits, cache.misses, len(cache.entries)) == (1, 1, 0)
+
+
+def test_entries_never_outlive_the_token(clock):
+    cache = PrincipalCache(ttl=60)
+    cache.put("token", user("alice"), token_exp=clock[0] + 10)
+    clock[0] += 10
+    assert cache.get("token") is None
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = PrincipalCache(max_size=2)
+    cache.put("a", user("alice"))
+    cache.put("b", user("bob"))
+    cache.get("a")
+    cache.put("c", user("carol"))
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.evictions == 1
+
+
+def test_invalidating_a_user_drops_all_of_their_tokens(clock):
+    cache = PrincipalCache()
+    cache.put("a1", user("alice"))
+    cache.put("a2", user("alice"))
+    cache.put("b", user("bob"))
+    cache.invalidate_user("alice")
+    assert list(cache.entries) == ["b"]
@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import DAY_SECONDS, RetentionManager, reading_rollups
+
+
+@pytest.fixture(autouse=True)
+def restore_rollup_retention():
+    # RetentionManager hands its tier settings to the shared rollup writer
+    retention = reading_rollups.retention
+    yield
+    reading_rollups.retention = retention
+
+
+def days(manager):
+    return {resolution: seconds / DAY_SECONDS for resolution, seconds in manager.rollup_seconds.items()}
+
+
+def test_settings_that_already_cover_the_tier_below_are_kept():
+    manager = RetentionManager(readings_days=30, rollup_days={"1m": 60, "1h": 730, "1d": 0})
+    assert days(manager) == {"1m": 60, "1h": 730, "1d": 0}
+    assert reading_rollups.retention == manager.rollup_seconds
+
+
+def test_short_tiers_are_raised_to_outlive_the_tier_below_by_a_coarser_bucket():
+    manager = RetentionManager(readings_days=30, rollup_days={"1m": 10, "1h": 20, "1d": 100})
+    assert days(manager) == pytest.approx({"1m": 30 + 1 / 24, "1h": 31 + 1 / 24, "1d": 100})
+
+
+def test_keeping_a_tier_forever_keeps_every_coarser_tier_forever():
+    assert days(RetentionManager(readings_days=0, rollup_days={"1m": 60, "1h": 730, "1d": 3650})) == {"1m": 0, "1h": 0, "1d": 0}
+    assert days(RetentionManager(readings_days=30, rollup_days={"1m": 60, "1h": 0, "1d": 3650})) == {"1m": 60, "1h": 0, "1d": 0}
+
+
+def test_raw_readings_are_kept_forever_by_default():
+    manager = RetentionManager(rollup_days={"1m": 60, "1h": 730, "1d": 0})
+    assert manager.readings_seconds == 0
+    assert days(manager) == {"1m": 0, "1h": 0, "1d": 0}
+
+
+def test_acknowledged_alerts_are_kept_forever_by_default():
+    assert RetentionManager().acknowledged_alert_seconds == 0
+
+
+def test_a_zero_retention_drops_only_the_ttl_index():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    alerts = mongomock_motor.AsyncMongoMockClient().db.alerts
+
+    async def indexes_after_drop():
+        await alerts.create_index([("acknowledged_at", 1)], expireAfterSeconds=90 * DAY_SECONDS)
+        await alerts.create_index([("acknowledged", 1), ("timestamp", -1)])
+        await RetentionManager.drop_ttl_index(alerts, "acknowledged_at")
+        return sorted(await alerts.index_information())
+
+    assert asyncio.run(indexes_after_drop()) == ["_id_", "acknowledged_1_timestamp_-1"]
+
+
+def test_the_rollup_projection_counts_every_reporting_device(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient().db
+    monkeypatch.setattr(server, "db", database)
+    # Simulator devices are not in the registry, but still fill rollups
+    monkeypatch.setattr(server, "device_registry", server.DeviceRegistry())
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    async def build():
+        await database.sensor_rollups.insert_many([
+            {"device_id": device_id, "resolution": "1h", "bucket": bucket, "count": 60}
+            for device_id in ("m1", "sim-1", "sim-2") for bucket in (hour, hour - timedelta(hours=1))
+        ] + [{"device_id": "retired", "resolution": "1h", "bucket": hour - timedelta(days=1), "count": 60}])
+        return await manager.storage_report()
+
+    manager = RetentionManager(readings_days=1, rollup_days={"1m": 2, "1h": 30, "1d": 365})
+    report = asyncio.run(build())
+    assert report["rates"]["reporting_devices"] == 3
+    rollups = report["collections"]["sensor_rollups"]
+    assert rollups["documents"] == 7
+    per_device = 2 * 1440 + 30 * 24 + 365
+    assert report["projected_steady_state_bytes"]["sensor_rollups"] == int(3 * per_device * rollups["size_bytes"] / 7)
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import server
+from server import SENSOR_METRICS, ReadingRollups, aggregate_buckets
+
+
+@pytest.fixture
+def raw():
+    rng = np.random.default_rng(13)
+    start = datetime(2025, 1, 16, 10, 0, tzinfo=timezone.utc)
+    rows = []
+    for device_id in ("a", "b"):
+        # Irregular arrivals with gaps, so some minutes and buckets are empty
+        offsets = np.sort(rng.choice(3 * 3600, size=400, replace=False))
+        for offset in offsets:
+            rows.append({"device_id": device_id, "timestamp": start + timedelta(seconds=int(offset)),
+                         **dict(zip(SENSOR_METRICS, rng.normal(50, 10, size=len(SENSOR_METRICS))))})
+    frame = pd.DataFrame(rows)
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"], utc=True)
+    return frame
+
+
+def rollup_frame(summaries):
+    # Same shape as ReadingRollups.load_frame builds from stored rollups
+    rows = []
+    for (device_id, bucket), summary in sorted(summaries.items()):
+        row = {"device_id": device_id, "timestamp": bucket, "count": summary["count"]}
+        for metric in SENSOR_METRICS:
+            for field in ("sum", "sumsq", "min", "max"):
+                row[f"{metric}_{field}"] = summary[metric][field]
+        rows.append(row)
+    frame = pd.DataFrame(rows)
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"], utc=True)
+    return frame
+
+
+@pytest.mark.parametrize("frequency", ["1min", "15min", "1h"])
+def test_rollup_buckets_match_raw_aggregation(raw, frequency):
+    aggregates = ["min", "max", "avg"]
+    rolled = ReadingRollups.aggregate(rollup_frame(ReadingRollups.summarize(raw, "1min")), frequency, aggregates)
+    expected = aggregate_buckets(raw, frequency, aggregates, SENSOR_METRICS)
+    assert len(rolled) == len(expected)
+    for point, reference in zip(rolled, expected):
+        assert point.keys() == reference.keys()
+        for key, value in reference.items():
+            assert point[key] == (pytest.approx(value, abs=1e-3) if isinstance(value, float) else value)
+
+
+def test_summaries_of_split_batches_add_up_to_the_whole(raw):
+    whole = ReadingRollups.summarize(raw, "1h")
+    parts = [ReadingRollups.summarize(raw.iloc[:300], "1h"), ReadingRollups.summarize(raw.iloc[300:], "1h")]
+    for key, summary in whole.items():
+        pieces = [part[key] for part in parts if key in part]
+        assert summary["count"] == sum(piece["count"] for piece in pieces)
+        for metric in SENSOR_METRICS:
+            assert summary[metric]["sum"] == pytest.approx(sum(piece[metric]["sum"] for piece in pieces))
+            assert summary[metric]["sumsq"] == pytest.approx(sum(piece[metric]["sumsq"] for piece in pieces))
+            assert summary[metric]["min"] == min(piece[metric]["min"] for piece in pieces)
+            assert summary[metric]["max"] == max(piece[metric]["max"] for piece in pieces)
+
+
+def test_failed_minutes_are_repaired_only_once_settled(monkeypatch):
+    rollups = ReadingRollups()
+    now = datetime.now(timezone.utc)
+    old = now - timedelta(minutes=10)
+    rollups.mark_stale([{"timestamp": old.replace(second=5)}, {"timestamp": old.replace(second=50)}])
+    rollups.mark_stale([{"timestamp": now}])
+    compacted = []
+
+    async def compact(from_time, to_time):
+        compacted.append((from_time, to_time))
+        return 1
+
+    monkeypatch.setattr(rollups, "compact", compact)
+    assert asyncio.run(rollups.repair(settle=120)) == 1
+    minute = old.replace(second=0, microsecond=0)
+    assert compacted == [(minute, minute + timedelta(minutes=1))]
+    assert len(rollups.stale) == 1
+
+
+def summary(count):
+    return {"count": count, **{metric: {"sum": 1.0, "sumsq": 1.0, "min": 1.0, "max": 1.0} for metric in SENSOR_METRICS}}
+
+
+def test_compaction_only_raises_rollups_that_miss_readings(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient().db
+    monkeypatch.setattr(server, "db", database)
+    minute = datetime(2025, 1, 16, 10, 0, tzinfo=timezone.utc)
+
+    async def run():
+        await database.sensor_rollups.insert_many([
+            {"device_id": "a", "resolution": "1m", "bucket": minute, **summary(2)},
+            {"device_id": "b", "resolution": "1m", "bucket": minute, **summary(5)},
+        ])
+        stale = await ReadingRollups().replace_stale("1m", {
+            ("a", minute): summary(3), ("b", minute): summary(4), ("c", minute + timedelta(minutes=1)): summary(1)
+        })
+        counts = {rollup["device_id"]: rollup["count"] async for rollup in database.sensor_rollups.find()}
+        return stale, counts
+
+    stale, counts = asyncio.run(run())
+    # b has fewer raw readings than rolled up, so its readings have started to expire
+    assert stale == {("a", minute), ("c", minute + timedelta(minutes=1))}
+    assert counts == {"a": 3, "b": 5, "c": 1}
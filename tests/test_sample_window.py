@@ -0,0 +1,23 @@
+import numpy as np
+
+from server import SampleWindow
+
+
+def test_keeps_the_most_recent_rows_in_arrival_order():
+    rng = np.random.default_rng(11)
+    window = SampleWindow(5, 3)
+    received = []
+    for size in [2, 4, 7, 1, 3]:
+        rows = rng.normal(size=(size, 3))
+        window.extend(rows)
+        received.extend(rows)
+        np.testing.assert_array_equal(window.samples(), np.array(received[-5:]))
+    assert len(window) == 5
+
+
+def test_copies_values_instead_of_referencing_the_batch():
+    window = SampleWindow(4, 3)
+    batch = np.ones((2, 3))
+    window.extend(batch)
+    batch[:] = 7
+    np.testing.assert_array_equal(window.samples(), np.ones((2, 3)))
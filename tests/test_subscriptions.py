@@ -0,0 +1,100 @@
+import pytest
+
+import server
+from server import ConnectionManager, Device, DeviceRegistry
+
+
+@pytest.fixture(autouse=True)
+def devices(monkeypatch):
+    registry = DeviceRegistry()
+    registry.add(Device(id="m1", name="Motor 1", type="motor", location="Plant A"))
+    registry.add(Device(id="c1", name="Compressor 1", type="compressor", location="Plant B"))
+    monkeypatch.setattr(server, "device_registry", registry)
+
+
+def receivers(manager, message_type, device_id=None, severity=None):
+    before = {client: client.queue.qsize() for client in manager.clients.values()}
+    manager.deliver({"type": message_type}, device_id, severity)
+    return {client for client, size in before.items() if client.queue.qsize() > size}
+
+
+def test_device_and_location_filters_route_through_the_topic_index(attach):
+    manager = ConnectionManager()
+    everything = attach(manager)
+    motor = attach(manager, {"device_ids": ["m1"]})
+    plant_b = attach(manager, {"locations": ["Plant B"]})
+    assert receivers(manager, "sensor_reading", "m1") == {everything, motor}
+    assert receivers(manager, "sensor_reading", "c1") == {everything, plant_b}
+    # Messages without a device go to every client
+    assert receivers(manager, "dashboard_summary") == {everything, motor, plant_b}
+
+
+def test_type_and_severity_filters(attach):
+    manager = ConnectionManager()
+    alerts_only = attach(manager, {"types": ["new_alert"], "min_severity": "high"})
+    readings = attach(manager, {"types": ["sensor_reading"]})
+    assert receivers(manager, "new_alert", "m1", "medium") == set()
+    assert receivers(manager, "new_alert", "m1", "critical") == {alerts_only}
+    assert receivers(manager, "sensor_reading", "m1") == {readings}
+
+
+def test_resubscribing_replaces_the_previous_topics(attach):
+    manager = ConnectionManager()
+    client = attach(manager, {"device_ids": ["m1"]})
+    manager.subscribe(client.websocket, {"locations": ["Plant B"]})
+    assert manager.by_device == {} and manager.by_location == {"Plant B": {client}}
+    assert client not in manager.unscoped
+    assert receivers(manager, "sensor_reading", "m1") == set()
+    assert receivers(manager, "sensor_reading", "c1") == {client}
+    manager.subscribe(client.websocket, {})
+    assert client in manager.unscoped and manager.by_location == {}
+
+
+def test_disconnecting_removes_a_client_from_every_topic(attach):
+    manager = ConnectionManager()
+    client = attach(manager, {"device_ids": ["m1", "c1"], "locations": ["Plant A"]})
+    manager.disconnect(client.websocket)
+    assert (manager.by_device, manager.by_location, manager.unscoped) == ({}, {}, set())
+
+
+@pytest.mark.parametrize("request_body", [{"types": "new_alert"}, {"device_ids": [["m1"]]}, {"min_severity": "urgent"}])
+def test_malformed_subscriptions_are_rejected_and_keep_the_old_one(attach, request_body):
+    manager = ConnectionManager()
+    client = attach(manager, {"device_ids": ["m1"]})
+    with pytest.raises(ValueError):
+        manager.subscribe(client.websocket, request_body)
+    assert manager.by_device == {"m1": {client}}
+    assert client.subscription()["device_ids"] == ["m1"]
+
+
+@pytest.fixture
+def websocket_client(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    async def authenticate(token):
+        return server.User(username="alice", email="alice@company.com")
+
+    monkeypatch.setattr(server, "authenticate_token", authenticate)
+    monkeypatch.setattr(server, "manager", ConnectionManager())
+    return TestClient(server.app)
+
+
+def test_the_endpoint_replies_with_an_error_to_a_malformed_subscription(websocket_client):
+    with websocket_client.websocket_connect("/ws?token=t") as websocket:
+        websocket.send_text('{"action": "subscribe", "types": "new_alert"}')
+        assert websocket.receive_json() == {"type": "error", "detail": "types must be a list of strings"}
+        websocket.send_text('{"action": "subscribe", "types": ["new_alert"]}')
+        assert websocket.receive_json()["subscription"]["types"] == ["new_alert"]
+    assert server.manager.clients == {}
+
+
+def test_the_endpoint_releases_the_client_when_handling_fails(websocket_client, monkeypatch):
+    def fail(websocket, request):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server.manager, "subscribe", fail)
+    with pytest.raises(RuntimeError):
+        with websocket_client.websocket_connect("/ws?token=t") as websocket:
+            websocket.send_text('{"action": "subscribe"}')
+            websocket.receive_text()
+    assert server.manager.clients == {} and server.manager.unscoped == set()
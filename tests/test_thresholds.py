@@ -0,0 +1,52 @@
+import numpy as np
+
+from server import AnomalyDetector, ThresholdConfig
+
+
+def evaluate(detector, device_type, power=20.0, temperature=50.0, vibration=2.0):
+    values = np.array([[power, temperature, vibration]])
+    return detector.evaluate_thresholds(["device-1"], [device_type], values)
+
+
+def test_readings_inside_thresholds_raise_nothing():
+    assert evaluate(AnomalyDetector(), "motor") == []
+
+
+def test_severity_follows_relative_deviation_from_the_threshold():
+    detector = AnomalyDetector()
+    # motor power_kw max is 50; buckets close at 10%, 30% and 50% over it
+    expected = {54: "low", 55: "low", 60: "medium", 70: "high", 75: "high", 80: "critical"}
+    for power, severity in expected.items():
+        alerts = evaluate(detector, "motor", power=power)
+        assert [(alert.metric, alert.severity, alert.threshold) for alert in alerts] == [("power_kw", severity, 50.0)]
+
+
+def test_breach_below_a_zero_threshold_is_critical():
+    # motor vibration min is 0, so the relative deviation divides by zero
+    alerts = evaluate(AnomalyDetector(), "motor", vibration=-0.5)
+    assert [(alert.metric, alert.severity) for alert in alerts] == [("vibration", "critical")]
+
+
+def test_unknown_device_types_have_no_thresholds():
+    assert evaluate(AnomalyDetector(), "boiler", power=1e6) == []
+
+
+def test_batch_evaluation_only_builds_alerts_for_violating_cells():
+    detector = AnomalyDetector()
+    values = np.array([
+        [20.0, 50.0, 2.0],   # motor, fine
+        [20.0, 95.0, 9.0],   # compressor, temperature and vibration over
+        [20.0, 30.0, 1.0],   # hvac, fine
+    ])
+    alerts = detector.evaluate_thresholds(["m", "c", "h"], ["motor", "compressor", "hvac"], values)
+    assert sorted((alert.device_id, alert.metric) for alert in alerts) == [("c", "temperature_c"), ("c", "vibration")]
+
+
+def test_type_override_replaces_one_bound_and_inherits_the_other():
+    detector = AnomalyDetector()
+    detector.apply_threshold_override(ThresholdConfig(device_type="motor", metric="power_kw", max_threshold=30))
+    assert [alert.threshold for alert in evaluate(detector, "motor", power=40)] == [30.0]
+    # min stays at the default 0.5
+    assert [alert.threshold for alert in evaluate(detector, "motor", power=0.1)] == [0.5]
+    detector.apply_threshold_override(ThresholdConfig(device_type="motor", metric="power_kw"), remove=True)
+    assert evaluate(detector, "motor", power=40) == []
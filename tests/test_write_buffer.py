@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect
+
+import server
+from server import WriteBehindBuffer
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+class FlakyCollection:
+    """Wraps a mock collection, failing the first calls as a dropped connection would"""
+
+    def __init__(self, collection, insert_failures=0, update_failures=0):
+        self.collection = collection
+        self.insert_failures = insert_failures
+        self.landed_insert_failures = 0
+        self.update_failures = update_failures
+        self.update_calls = 0
+
+    async def insert_many(self, documents, ordered=True):
+        if self.insert_failures:
+            self.insert_failures -= 1
+            raise AutoReconnect("connection reset")
+        if self.landed_insert_failures:
+            self.landed_insert_failures -= 1
+            # The documents were stored, but the reply was lost
+            await self.collection.insert_many(documents, ordered=ordered)
+            raise AutoReconnect("connection reset")
+        return await self.collection.insert_many(documents, ordered=ordered)
+
+    def find(self, *args, **kwargs):
+        return self.collection.find(*args, **kwargs)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.update_calls += 1
+        if self.update_failures:
+            self.update_failures -= 1
+            # The update may well have been applied before the connection dropped
+            await self.collection.bulk_write(operations, ordered=ordered)
+            raise AutoReconnect("connection reset")
+        return await self.collection.bulk_write(operations, ordered=ordered)
+
+
+@pytest.fixture
+def alerts(monkeypatch):
+    collection = FlakyCollection(mongomock_motor.AsyncMongoMockClient().db.alerts)
+    monkeypatch.setattr(server, "db", {"alerts": collection})
+    return collection
+
+
+@pytest.fixture
+def readings(monkeypatch):
+    # Like a time-series collection, no unique index on id
+    collection = FlakyCollection(mongomock_motor.AsyncMongoMockClient().db.sensor_readings)
+    monkeypatch.setattr(server, "db", {"sensor_readings": collection})
+    monkeypatch.setattr(server.reading_rollups, "apply", lambda stored: asyncio.sleep(0))
+    return collection
+
+
+def buffer():
+    return WriteBehindBuffer(batch_size=10, flush_interval_ms=10, max_attempts=3, retry_backoff_ms=0)
+
+
+def test_inserts_are_retried_after_transient_failures(alerts):
+    alerts.insert_failures = 2
+    write_buffer = buffer()
+    documents = [{"id": f"a{index}", "timestamp": datetime.now(timezone.utc)} for index in range(3)]
+
+    async def flush():
+        await write_buffer.put_many("alerts", documents)
+        await write_buffer.stop()
+        return await alerts.collection.count_documents({})
+
+    assert asyncio.run(flush()) == 3
+    assert (write_buffer.written, write_buffer.retries, write_buffer.dropped) == (3, 2, 0)
+
+
+def test_retried_inserts_skip_what_already_landed(readings):
+    readings.landed_insert_failures = 1
+    write_buffer = buffer()
+    now = datetime.now(timezone.utc)
+    documents = [{"id": f"r{index}", "device_id": "d", "timestamp": now, "power_kw": 1.0} for index in range(3)]
+
+    async def flush():
+        await write_buffer.put_many("sensor_readings", documents)
+        await write_buffer.stop()
+        return await readings.collection.count_documents({})
+
+    assert asyncio.run(flush()) == 3
+    assert (write_buffer.written, write_buffer.retries, write_buffer.failed) == (3, 1, 0)
+
+
+def test_inserts_are_dropped_after_the_last_attempt(alerts):
+    alerts.insert_failures = 3
+    write_buffer = buffer()
+
+    async def flush():
+        await write_buffer.put_many("alerts", [{"id": "a"}, {"id": "b"}])
+        await write_buffer.stop()
+
+    asyncio.run(flush())
+    assert (write_buffer.written, write_buffer.dropped, write_buffer.pending) == (0, 2, 0)
+
+
+def test_counter_updates_are_never_rerun(alerts):
+    alerts.update_failures = 1
+    write_buffer = buffer()
+
+    async def flush():
+        await write_buffer.put("alerts", {"id": "a", "occurrences": 1})
+        await write_buffer.put("alerts", UpdateOne({"id": "a"}, {"$inc": {"occurrences": 4}}))
+        await write_buffer.stop()
+        return await alerts.collection.find_one({"id": "a"})
+
+    assert asyncio.run(flush())["occurrences"] == 5
+    assert alerts.update_calls == 1
+    assert (write_buffer.written, write_buffer.dropped) == (1, 1)
+
+
+def test_stop_drains_what_the_running_flusher_has_queued(alerts):
+    write_buffer = buffer()
+
+    async def run():
+        write_buffer.start()
+        await write_buffer.put_many("alerts", [{"id": f"a{index}"} for index in range(25)])
+        await write_buffer.stop()
+        return await alerts.collection.count_documents({})
+
+    assert asyncio.run(run()) == 25
+    assert write_buffer.pending == 0 and write_buffer.task is None